@@ -18,6 +18,7 @@ Summary:        Koji integration plugins for image-builder
 BuildRequires:  python3-devel
 BuildRequires:  python3dist(koji)
 BuildRequires:  python3dist(pytest) python3dist(pytest-mock)
+BuildRequires:  python3dist(pyyaml)
 
 %description
 Koji integration plugins for image-builder.
@@ -35,6 +36,7 @@ Koji hub plugin for image-builder integration.
 Summary:        Koji builder plugin for image-builder integration
 Requires:       %{name} = %{version}-%{release}
 Requires:       koji-builder koji-builder-plugins
+Requires:       zstd xz
 
 %description    builder
 Koji builder plugin for image-builder integration.
@@ -43,6 +45,7 @@ Koji builder plugin for image-builder integration.
 Summary:        Koji cli plugin for image-cli integration
 Requires:       %{name} = %{version}-%{release}
 Requires:       koji python3-koji-cli-plugins
+Requires:       python3-pyyaml
 
 %description    cli
 Koji cli plugin for image-cli integration.
@@ -64,6 +67,8 @@ install -p -m 0755 plugin/hub/image_builder.py %{buildroot}/%{_prefix}/lib/koji-
 install -d %{buildroot}/%{_prefix}/lib/koji-builder-plugins
 install -p -m 0755 plugin/builder/image_builder.py %{buildroot}/%{_prefix}/lib/koji-builder-plugins/
 %py_byte_compile %{python3} %{buildroot}/%{_prefix}/lib/koji-builder-plugins/image_builder.py
+install -d %{buildroot}%{_sysconfdir}/kojid/plugins
+install -p -m 0644 plugin/builder/image_builder.conf %{buildroot}%{_sysconfdir}/kojid/plugins/image_builder.conf
 
 install -d %{buildroot}/%{python3_sitelib}/koji_cli_plugins
 install -p -m 0644 plugin/cli/image_builder.py %{buildroot}%{python3_sitelib}/koji_cli_plugins/image_builder.py
@@ -79,6 +84,7 @@ install -p -m 0644 plugin/cli/image_builder.py %{buildroot}%{python3_sitelib}/ko
 %files builder
 %{_prefix}/lib/koji-builder-plugins/image_builder.py
 %{_prefix}/lib/koji-builder-plugins/__pycache__/image_builder.*
+%config(noreplace) %{_sysconfdir}/kojid/plugins/image_builder.conf
 
 %files cli
 %pycached %{python3_sitelib}/koji_cli_plugins/image_builder.py
@@ -6,10 +6,23 @@
 # into `koji` itself but first they have to prove themselves stability wise.
 
 import os
+import re
 import json
+import errno
+import time
+import queue
+import fcntl
+import shlex
+import hashlib
+import shutil
+import subprocess
 import logging
+import threading
+import contextlib
+import concurrent.futures
 
 import koji
+import koji.util
 
 from koji.tasks import ServerExit
 
@@ -17,6 +30,15 @@ from __main__ import BaseBuildTask, BuildImageTask, BuildRoot
 
 logger = logging.getLogger("koji.plugin.image_builder")
 
+# Settings that are specific to a builder host, such as the location and size
+# of caches, are read from this file. It is optional, without it all of the
+# features it configures are disabled.
+CONFIG_FILE = "/etc/kojid/plugins/image_builder.conf"
+
+# `kojid` writes the `mock` configuration of each build root into this
+# directory, named after the build root's `mockcfg`.
+MOCK_CONFIG_DIR = "/etc/mock"
+
 
 # When `image-builder` is ran inside `mock` (which is what `koji` uses for its
 # build roots) there are complications. `mock` can run with various isolation
@@ -85,6 +107,60 @@ chroot "$NEW_ROOT" "$@"
 """
 
 
+# Running multiple commands at the same time inside the build root is done by
+# a single `mock` invocation of the script below. We can't call `mock` from
+# multiple threads as the build root shares its `koji` session with the task.
+
+# Each job is a small shell script that redirects its own output into a log
+# file. The exit status of every job is written next to it so we can find out
+# which of the jobs failed. When fail fast is requested the remaining jobs are
+# killed as soon as one of them fails, killed jobs don't get a status.
+MOCK_PARALLEL_RUNNER = """
+#!/bin/bash
+#
+# usage: parallel-run <max-jobs> <fail-fast> <job>...
+set -uo pipefail
+
+max="$1"
+failfast="$2"
+shift 2
+
+declare -A running=()
+
+reap() {
+    local pid status
+
+    wait -n -p pid
+    status=$?
+
+    echo "$status" > "${running[$pid]}.status"
+    unset "running[$pid]"
+
+    if [ "$status" -ne 0 ] && [ "$failfast" = "1" ]; then
+        for pid in "${!running[@]}"; do
+            kill "$pid" 2>/dev/null
+        done
+
+        wait
+        exit 1
+    fi
+}
+
+for job in "$@"; do
+    while [ "${#running[@]}" -ge "$max" ]; do
+        reap
+    done
+
+    sh "$job" &
+    running[$!]="$job"
+done
+
+while [ "${#running[@]}" -gt 0 ]; do
+    reap
+done
+"""
+
+
 # Helpers
 def arches_for_config(build_config):
     """The architectures field for a build tag is a string. Verify that there
@@ -109,6 +185,1167 @@ def target_repo(topdir, target_info, repo_info):
     return f"{repo}/$arch"
 
 
+def read_config():
+    """Read the builder host configuration for the plugin, a missing
+    configuration file results in an empty configuration."""
+
+    return koji.read_config_files([(CONFIG_FILE, False)])
+
+
+def parse_size(size):
+    """Parse a size as used in the configuration file, these are a number of
+    bytes optionally followed by a K, M, G, or T suffix."""
+
+    size = size.strip().upper()
+    suffixes = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+    if size and size[-1] in suffixes:
+        return int(size[:-1]) * suffixes[size[-1]]
+
+    return int(size)
+
+
+def container_layers(storage):
+    """The layers in container storage, by their id, with the size that was
+    pulled for each of them. `containers/storage` records the compressed size
+    of a layer in the layer list of its graph driver, this list is read
+    instead of walking the storage itself."""
+
+    layers = {}
+
+    if not os.path.isdir(storage):
+        return layers
+
+    for entry in os.listdir(storage):
+        if not entry.endswith("-layers"):
+            continue
+
+        for name in ("layers.json", "volatile-layers.json"):
+            try:
+                with open(os.path.join(storage, entry, name)) as f:
+                    for layer in json.load(f):
+                        layers[layer["id"]] = layer.get("compressed-size", 0)
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+
+    return layers
+
+
+def disk_usage(path):
+    """The amount of bytes on disk that are used by a path, directories are
+    walked without following symlinks."""
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_blocks * 512
+
+    total = 0
+
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+
+    return total
+
+
+def data_extents(path):
+    """The data extents of a file as a list of `(offset, length)`, everything
+    in between is a hole. Filesystems that don't track holes report the whole
+    file as data."""
+
+    extents = []
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+
+        while offset < size:
+            try:
+                start = os.lseek(f.fileno(), offset, os.SEEK_DATA)
+            except OSError as e:
+                # there is no more data after `offset`
+                if e.errno == errno.ENXIO:
+                    break
+
+                raise
+
+            offset = os.lseek(f.fileno(), start, os.SEEK_HOLE)
+            extents.append((start, offset - start))
+
+    return extents
+
+
+class HostCache:
+    """A directory on the builder host that is shared between tasks. Each
+    entry in the cache is a directory identified by a key with a lock file next
+    to it. Entries are locked while a task uses them. When the cache grows
+    beyond its maximum size the least recently used unlocked entries are
+    removed."""
+
+    def __init__(self, path, max_size, slots=1, max_age=None):
+        self.path = path
+        self.max_size = max_size
+
+        # Entries that haven't been used for `max_age` seconds are removed
+        # regardless of the size of the cache.
+        self.max_age = max_age
+
+        # The amount of entries that can exist for the same key, this allows
+        # concurrent tasks to each use their own copy of an entry.
+        self.slots = slots
+
+    @classmethod
+    def from_config(cls, config, section):
+        """Create a cache from a section in the configuration file, returns
+        `None` when the cache is not configured."""
+
+        if not config.has_option(section, "path"):
+            return None
+
+        max_size = parse_size(config.get(section, "max_size", fallback="10G"))
+        slots = config.getint(section, "slots", fallback=1)
+
+        max_age = None
+
+        if config.has_option(section, "max_age"):
+            max_age = config.getfloat(section, "max_age") * 24 * 60 * 60
+
+        return cls(config.get(section, "path"), max_size, slots, max_age)
+
+    def _lock(self, name, mode):
+        path = os.path.join(self.path, f"{name}.lock")
+
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+
+            # Lock files are removed together with their entry while they're
+            # locked. A lock on a file that was removed in the meantime is no
+            # lock at all, try again with the current file.
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+
+            os.close(fd)
+
+    def acquire(self, key):
+        """Lock an entry for `key`, creating it when it doesn't exist yet.
+        Returns the path to the entry and a function to release it, or `None`
+        when all slots for the key are in use by other tasks."""
+
+        koji.ensuredir(self.path)
+
+        for slot in range(self.slots):
+            name = key if slot == 0 else f"{key}.{slot}"
+
+            fd = self._lock(name, fcntl.LOCK_EX)
+
+            if fd is None:
+                continue
+
+            path = os.path.join(self.path, name)
+            hit = os.path.isdir(path)
+
+            koji.ensuredir(path)
+            os.utime(path)
+
+            logger.info("using cache entry %s (hit: %s)", path, hit)
+
+            def release(fd=fd):
+                self.prune()
+                os.close(fd)
+
+            return path, release
+
+        logger.info("all cache entries for %s are in use", key)
+
+        return None
+
+    def prune(self):
+        """Remove the least recently used unlocked entries until the cache
+        fits within its maximum size, and any unlocked entries that are older
+        than the maximum age."""
+
+        entries = []
+
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+
+            if name.endswith(".lock") or name.startswith("."):
+                continue
+
+            stat = os.lstat(path)
+            entries.append(
+                (max(stat.st_atime, stat.st_mtime), name, disk_usage(path))
+            )
+
+        total = sum(size for (_, _, size) in entries)
+
+        expired = 0
+
+        if self.max_age is not None:
+            expired = time.time() - self.max_age
+
+        for used, name, size in sorted(entries):
+            if total <= self.max_size and used >= expired:
+                break
+
+            fd = self._lock(name, fcntl.LOCK_EX)
+
+            if fd is None:
+                continue
+
+            try:
+                path = os.path.join(self.path, name)
+
+                logger.info("removing cache entry %s (%d bytes)", path, size)
+
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+
+                # Keys change with every new repository, the lock file goes
+                # with its entry so they don't pile up.
+                os.unlink(f"{path}.lock")
+
+                total -= size
+            finally:
+                os.close(fd)
+
+
+class SharedHostCache(HostCache):
+    """A directory on the builder host that is used by multiple tasks at the
+    same time. Files are only ever added to it with atomic renames so tasks
+    can fill it concurrently. Tasks hold a shared lock while they use the
+    cache, the least recently used files are only removed by the last task to
+    stop using it."""
+
+    def acquire(self, key):
+        """Lock the cache for `key` as shared. Returns the path to the cache
+        and a function to release it, or `None` while the cache is being
+        pruned by another task."""
+
+        koji.ensuredir(self.path)
+
+        fd = self._lock(key, fcntl.LOCK_SH)
+
+        if fd is None:
+            logger.info("cache %s is being pruned", key)
+            return None
+
+        path = os.path.join(self.path, key)
+        koji.ensuredir(path)
+
+        logger.info("using shared cache %s", path)
+
+        def release(fd=fd):
+            # The lock can only be made exclusive when no other task is
+            # using the cache.
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pass
+            else:
+                self.prune_files(path)
+            finally:
+                os.close(fd)
+
+        return path, release
+
+    def prune_files(self, path):
+        """Remove the least recently used files until the cache fits within
+        its maximum size, and any files that are older than the maximum
+        age."""
+
+        entries = []
+
+        for root, _, files in os.walk(path):
+            for name in files:
+                file = os.path.join(root, name)
+                stat = os.lstat(file)
+
+                entries.append(
+                    (max(stat.st_atime, stat.st_mtime), file, stat.st_blocks * 512)
+                )
+
+        total = sum(size for (_, _, size) in entries)
+
+        expired = 0
+
+        if self.max_age is not None:
+            expired = time.time() - self.max_age
+
+        removed = 0
+
+        for used, file, size in sorted(entries):
+            if total <= self.max_size and used >= expired:
+                break
+
+            os.unlink(file)
+
+            total -= size
+            removed += 1
+
+        if removed:
+            logger.info("removed %d files from cache %s", removed, path)
+
+
+# Lines in the verbose output of `osbuild` that start a pipeline or a stage,
+# and that report the duration of a stage once it's done.
+OSBUILD_PIPELINE = re.compile(r"^Pipeline (?P<name>[^:\s]+): [0-9a-f]{64}")
+OSBUILD_STAGE = re.compile(r"^(?P<name>org\.osbuild\.[\w.-]+): [0-9a-f]{64}")
+OSBUILD_DURATION = re.compile(r"Duration: (?P<seconds>\d+(\.\d+)?)s")
+
+# Terminal escape sequences that can be part of `osbuild` output.
+ESCAPE_SEQUENCE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+
+class Profile:
+    """The durations of the phases of a task, relative to its start, and of
+    the `osbuild` stages that ran during it. Phases can be added from multiple
+    threads."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = []
+        self.stages = []
+        self.lock = threading.Lock()
+
+        # Whether each host cache that was used was a hit, a miss, or busy.
+        self.caches = {}
+
+    def add(self, name, start, duration, **extra):
+        with self.lock:
+            self.phases.append(
+                {
+                    "name": name,
+                    "start": round(start - self.start, 3),
+                    "duration": round(duration, 3),
+                    **extra,
+                }
+            )
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Record the duration of a phase, phases that raise are marked as
+        failed. Anything that is put in the yielded dictionary is recorded
+        with the phase."""
+
+        start = time.monotonic()
+        extra = {}
+
+        try:
+            yield extra
+        except BaseException:
+            self.add(name, start, time.monotonic() - start, failed=True, **extra)
+            raise
+
+        self.add(name, start, time.monotonic() - start, **extra)
+
+    def parse_log(self, path):
+        """Add the `osbuild` stages and their durations that are found in a
+        log, missing logs are ignored."""
+
+        if not os.path.exists(path):
+            return
+
+        pipeline = None
+        stage = None
+
+        with open(path, errors="replace") as f:
+            for line in f:
+                line = ESCAPE_SEQUENCE.sub("", line).strip()
+
+                match = OSBUILD_PIPELINE.match(line)
+
+                if match:
+                    pipeline = match.group("name")
+                    continue
+
+                match = OSBUILD_STAGE.match(line)
+
+                if match:
+                    stage = match.group("name")
+                    continue
+
+                match = OSBUILD_DURATION.search(line)
+
+                if match and stage:
+                    self.stages.append(
+                        {
+                            "log": os.path.basename(path),
+                            "pipeline": pipeline,
+                            "stage": stage,
+                            "duration": float(match.group("seconds")),
+                        }
+                    )
+
+                    stage = None
+
+    def summary(self):
+        """The total duration, the duration of each phase with uploads added
+        together, and the total duration of each kind of stage."""
+
+        phases = {}
+        stages = {}
+        upload = 0
+
+        for phase in self.phases:
+            if phase["name"].startswith("upload-"):
+                upload += phase["duration"]
+            else:
+                phases[phase["name"]] = phase["duration"]
+
+        for stage in self.stages:
+            stages[stage["stage"]] = stages.get(stage["stage"], 0) + stage["duration"]
+
+        return {
+            "total": round(time.monotonic() - self.start, 3),
+            "phases": phases,
+            "upload": round(upload, 3),
+            "stages": stages,
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "summary": self.summary(),
+                    "phases": self.phases,
+                    "stages": self.stages,
+                    "caches": self.caches,
+                },
+                f,
+                indent=2,
+            )
+
+
+# The metrics that are exported, with their type, help text, and for histograms
+# their buckets.
+METRICS = {
+    "koji_image_builder_tasks_total": (
+        "counter",
+        "Architecture tasks that finished",
+        None,
+    ),
+    "koji_image_builder_build_duration_seconds": (
+        "histogram",
+        "Duration of building image types",
+        [60, 300, 600, 1200, 1800, 3600, 7200],
+    ),
+    "koji_image_builder_container_pull_duration_seconds": (
+        "histogram",
+        "Duration of pulling the containers of a task",
+        [10, 30, 60, 120, 300, 600],
+    ),
+    "koji_image_builder_container_pull_bytes_total": (
+        "counter",
+        "Bytes added to container storage by pulls",
+        None,
+    ),
+    "koji_image_builder_upload_bytes_total": (
+        "counter",
+        "Bytes uploaded to the hub",
+        None,
+    ),
+    "koji_image_builder_upload_duration_seconds_total": (
+        "counter",
+        "Time spent uploading to the hub",
+        None,
+    ),
+    "koji_image_builder_cache_requests_total": (
+        "counter",
+        "Host cache requests by result",
+        None,
+    ),
+    "koji_image_builder_failures_total": (
+        "counter",
+        "Failed architecture tasks by the phase that failed",
+        None,
+    ),
+}
+
+
+class Metrics:
+    """Metrics of the tasks on a builder host, exported as a textfile for the
+    textfile collector of `node_exporter`. Every task adds its own values to
+    the totals of all previous tasks, which are kept in a state file next to
+    the textfile. Both files are only replaced as a whole."""
+
+    def __init__(self, path):
+        self.path = path
+        self.counters = {}
+        self.histograms = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Create metrics from the configuration file, returns `None` when
+        metrics are not configured."""
+
+        if not config.has_option("metrics", "path"):
+            return None
+
+        return cls(config.get("metrics", "path"))
+
+    @staticmethod
+    def _key(name, labels):
+        return json.dumps([name, labels], sort_keys=True)
+
+    def average(self, name, labels):
+        """The average of a histogram over all previous tasks, or `None` when
+        nothing was observed yet."""
+
+        try:
+            with open(f"{self.path}.json") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if not isinstance(state, dict):
+            return None
+
+        histogram = state.get("histograms", {}).get(self._key(name, labels))
+
+        if not histogram or not histogram.get("count"):
+            return None
+
+        return histogram["sum"] / histogram["count"]
+
+    def inc(self, name, labels, value=1):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = self._key(name, labels)
+        buckets = METRICS[name][2]
+
+        histogram = self.histograms.setdefault(
+            key, {"buckets": [0] * len(buckets), "sum": 0, "count": 0}
+        )
+
+        for i, bucket in enumerate(buckets):
+            if value <= bucket:
+                histogram["buckets"][i] += 1
+
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def merge(self, state):
+        """Add the values of this task to the `state` of previous tasks."""
+
+        for key, value in self.counters.items():
+            state["counters"][key] = state["counters"].get(key, 0) + value
+
+        for key, histogram in self.histograms.items():
+            total = state["histograms"].setdefault(
+                key,
+                {"buckets": [0] * len(histogram["buckets"]), "sum": 0, "count": 0},
+            )
+
+            total["buckets"] = [
+                a + b for a, b in zip(total["buckets"], histogram["buckets"])
+            ]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+
+        return state
+
+    @staticmethod
+    def format(state):
+        """Format the state as text in the Prometheus exposition format."""
+
+        families = {}
+
+        for key, value in state["counters"].items():
+            name, labels = json.loads(key)
+            families.setdefault(name, []).append((labels, value))
+
+        for key, histogram in state["histograms"].items():
+            name, labels = json.loads(key)
+            families.setdefault(name, []).append((labels, histogram))
+
+        def sample(name, labels, value, le=None):
+            pairs = sorted(labels.items())
+
+            if le is not None:
+                pairs.append(("le", le))
+
+            text = ",".join(f'{k}="{v}"' for k, v in pairs)
+
+            return f"{name}{{{text}}} {value}\n"
+
+        lines = []
+
+        for name in sorted(families):
+            kind, description, buckets = METRICS[name]
+
+            lines.append(f"# HELP {name} {description}\n")
+            lines.append(f"# TYPE {name} {kind}\n")
+
+            samples = sorted(families[name], key=lambda x: sorted(x[0].items()))
+
+            for labels, value in samples:
+                if kind == "counter":
+                    lines.append(sample(name, labels, value))
+                    continue
+
+                counts = value["buckets"] + [value["count"]]
+
+                for bucket, count in zip(buckets + ["+Inf"], counts):
+                    lines.append(sample(f"{name}_bucket", labels, count, str(bucket)))
+
+                lines.append(sample(f"{name}_sum", labels, value["sum"]))
+                lines.append(sample(f"{name}_count", labels, value["count"]))
+
+        return "".join(lines)
+
+    def write(self):
+        """Add the values of this task to the state and replace the textfile.
+        Tasks on the same host take turns through a lock file."""
+
+        directory = os.path.dirname(self.path)
+        koji.ensuredir(directory)
+
+        with open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            state = {"counters": {}, "histograms": {}}
+
+            try:
+                with open(f"{self.path}.json") as f:
+                    state = json.load(f)
+            except FileNotFoundError:
+                pass
+
+            state = self.merge(state)
+
+            for path, content in (
+                (f"{self.path}.json", json.dumps(state)),
+                (self.path, self.format(state)),
+            ):
+                # Files are written next to their destination and renamed
+                # into place so readers never see a partial file.
+                with open(f"{path}.tmp", "w") as f:
+                    f.write(content)
+
+                os.rename(f"{path}.tmp", path)
+
+
+ZEROS = bytes(1 << 20)
+
+
+def hash_zeros(checksum, length):
+    """Update a checksum with `length` zero bytes."""
+
+    with memoryview(ZEROS) as zeros:
+        while length > 0:
+            checksum.update(zeros[: min(length, len(ZEROS))])
+            length -= len(ZEROS)
+
+
+# Compression that can be applied to artifacts while they are uploaded, with
+# the suffix of the compressed file and the command that writes the compressed
+# contents of a file to stdout.
+COMPRESSORS = {
+    "zstd": ("zst", ["zstd", "-T0", "-q", "-c"]),
+    "xz": ("xz", ["xz", "-T0", "-c"]),
+}
+
+# Only artifacts in these formats are compressed, other formats are either
+# compressed already or too small to matter.
+COMPRESSIBLE = (".raw", ".img", ".tar")
+
+
+class ArtifactUploader:
+    """Uploads the artifacts of a task to the hub. In pipelined mode the
+    uploads happen in a background thread so they can overlap with building
+    the next image type. The background thread uses its own session as a
+    session can't be used by multiple threads at the same time.
+
+    Every file is read exactly once, the sha256 and size of each file are
+    computed from the same buffers that are uploaded. With `sparse` enabled
+    only the data extents of sparse files are read and uploaded, the hub
+    recreates the holes. With `compress` set uncompressed disk images and
+    archives are streamed through a compressor on their way to the hub."""
+
+    def __init__(
+        self,
+        task,
+        pipelined=False,
+        streams=1,
+        blocksize=8 << 20,
+        min_size=1 << 30,
+        sparse=False,
+        compress=None,
+        profile=None,
+        stock=False,
+    ):
+        self.task = task
+        self.sparse = sparse
+
+        # In stock mode files that aren't compressed are uploaded by koji
+        # itself, with the upload options of `kojid`.
+        self.stock = stock
+
+        # The duration and size of each upload are added to the profile.
+        self.profile = profile
+
+        if compress is not None and compress not in COMPRESSORS:
+            raise koji.GenericError(f"unsupported compression: {compress}")
+
+        self.compress = compress
+
+        # Files of at least `min_size` bytes are uploaded over `streams`
+        # connections at the same time, in blocks of `blocksize` bytes.
+        self.streams = streams
+        self.blocksize = blocksize
+        self.min_size = min_size
+
+        # The names of all files that were uploaded, in order, and their
+        # checksums and sizes.
+        self.files = []
+        self.file_info = {}
+
+        self.session = None
+        self.executor = None
+        self.futures = []
+        self.seen = set()
+
+        # Each connection of a striped upload needs its own session, these are
+        # created for the first file that is striped and kept around for all
+        # other files that are uploaded in this manner.
+        self.stream_sessions = []
+        self.stream_executor = None
+
+        # Buffers are reused between chunks, they are only allocated when all
+        # of the existing ones are in flight.
+        self.buffers = queue.Queue()
+
+        if pipelined:
+            self.session = task.session.subsession()
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    @classmethod
+    def from_config(cls, task, config, compress=None, profile=None):
+        """Create an uploader from the `[upload]` section of the configuration
+        file. Without that section files are uploaded by koji itself, unless
+        they're compressed. The block size defaults to the `upload_blocksize`
+        of `kojid`."""
+
+        blocksize = getattr(task.options, "upload_blocksize", None) or 8 << 20
+
+        return cls(
+            task,
+            pipelined=config.getboolean("upload", "pipelined", fallback=False),
+            streams=config.getint("upload", "streams", fallback=1),
+            blocksize=parse_size(
+                config.get("upload", "blocksize", fallback=str(blocksize))
+            ),
+            min_size=parse_size(config.get("upload", "min_size", fallback="1G")),
+            sparse=config.getboolean("upload", "sparse", fallback=False),
+            compress=compress,
+            profile=profile,
+            stock=not config.has_section("upload"),
+        )
+
+    def buffer(self):
+        try:
+            return self.buffers.get_nowait()
+        except queue.Empty:
+            return bytearray(self.blocksize)
+
+    def upload(self, path, name, compress=None):
+        start = time.monotonic()
+
+        if compress is None and self.stock:
+            self.task.uploadFile(path, remoteName=name)
+
+            logger.info("uploaded %s", name)
+
+            if self.profile is not None:
+                self.profile.add(
+                    f"upload-{name}",
+                    start,
+                    time.monotonic() - start,
+                    size=os.path.getsize(path),
+                )
+
+            return
+
+        if compress is not None:
+            checksum, length = self.upload_compressed(path, name, compress)
+        else:
+            stat = os.stat(path)
+            size = stat.st_size
+
+            extents = None
+
+            if self.sparse and stat.st_blocks * 512 < size:
+                extents = data_extents(path)
+
+            with open(path, "rb") as f:
+                if extents is not None:
+                    checksum, length = self.upload_striped(f, name, size, extents)
+                elif self.streams > 1 and size >= self.min_size:
+                    checksum, length = self.upload_striped(f, name, size)
+                else:
+                    checksum, length = self.upload_single(f, name)
+
+        self.file_info[name] = {
+            "checksum_type": "sha256",
+            "checksum": checksum,
+            "filesize": length,
+        }
+
+        if compress is not None:
+            self.file_info[name]["compression"] = compress
+
+        logger.info("uploaded %s (%d bytes, sha256:%s)", name, length, checksum)
+
+        if self.profile is not None:
+            self.profile.add(
+                f"upload-{name}", start, time.monotonic() - start, size=length
+            )
+
+    def upload_compressed(self, path, name, compress):
+        """Upload a file through a compressor. The compressed contents are
+        read from a pipe and never written to disk, the checksum and size are
+        those of the compressed file."""
+
+        command = COMPRESSORS[compress][1] + [path]
+
+        with subprocess.Popen(command, stdout=subprocess.PIPE) as proc:
+            try:
+                if self.streams > 1 and os.path.getsize(path) >= self.min_size:
+                    result = self.upload_striped(proc.stdout, name)
+                else:
+                    result = self.upload_single(proc.stdout, name)
+            except BaseException:
+                proc.kill()
+                raise
+
+        if proc.returncode != 0:
+            raise koji.GenericError(f"`{command[0]}` failed to compress {path}")
+
+        return result
+
+    def upload_chunk(self, session, chunk, offset, name):
+        result = session.rawUpload(
+            chunk, offset, self.task.getUploadDir(), name, overwrite=True
+        )
+
+        if result["size"] != len(chunk):
+            raise koji.GenericError(
+                f"server returned wrong chunk size for {name}: "
+                f"{result['size']} != {len(chunk)}"
+            )
+
+        hexdigest = koji.util.adler32_constructor(chunk).hexdigest()
+
+        if result["hexdigest"] != hexdigest:
+            raise koji.GenericError(f"upload checksum failed for {name}")
+
+    def upload_single(self, f, name):
+        """Upload a file over a single connection."""
+
+        session = self.session or self.task.session
+
+        checksum = hashlib.sha256()
+        length = 0
+
+        buffer = self.buffer()
+        view = memoryview(buffer)
+
+        try:
+            while True:
+                size = f.readinto(buffer)
+
+                # Empty files still need to be created on the hub.
+                if not size and length:
+                    break
+
+                chunk = view[:size]
+
+                checksum.update(chunk)
+                self.upload_chunk(session, chunk, length, name)
+
+                length += size
+
+                if not size:
+                    break
+        finally:
+            view.release()
+            self.buffers.put(buffer)
+
+        result = session.checkUpload(self.task.getUploadDir(), name)
+
+        if result is None or int(result["size"]) != length:
+            raise koji.GenericError(f"uploaded file has the wrong size: {name}")
+
+        return checksum.hexdigest(), length
+
+    def upload_striped(self, f, name, size=None, extents=None):
+        """Upload a single file over multiple connections. The file is read
+        once, in blocks that are distributed round robin over a part file per
+        connection. The hub puts the parts back together and verifies the
+        checksum of the uploaded data. When the `size` isn't known up front,
+        such as for a pipe, the file is read until its end.
+
+        When the data `extents` of a sparse file are passed only those are
+        uploaded. The checksum of the whole file is still returned, the holes
+        are hashed from memory without reading them."""
+
+        sparse = extents is not None
+
+        if size is None:
+            streams = max(1, self.streams)
+        else:
+            data = sum(extent[1] for extent in extents) if sparse else size
+            streams = max(1, min(self.streams, -(-data // self.blocksize)))
+
+        if self.stream_executor is None:
+            self.stream_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(self.streams, 1)
+            )
+
+        queues = [queue.Queue(maxsize=2) for _ in range(streams)]
+        failed = threading.Event()
+
+        futures = [
+            self.stream_executor.submit(
+                self.upload_stream,
+                self.stream_sessions[i],
+                queues[i],
+                f"{name}.part{i}",
+                failed,
+            )
+            for i in range(streams)
+        ]
+
+        checksum = hashlib.sha256()
+        file_checksum = hashlib.sha256() if sparse else None
+        length = 0
+
+        try:
+            blocks = self.read_blocks(f, extents, size, file_checksum)
+
+            for index, (buffer, filled) in enumerate(blocks):
+                with memoryview(buffer) as view:
+                    checksum.update(view[:filled])
+
+                length += filled
+
+                queues[index % streams].put((buffer, filled))
+
+                if failed.is_set():
+                    break
+        finally:
+            for q in queues:
+                q.put(None)
+
+        for future in futures:
+            future.result()
+
+        (self.session or self.task.session).host.imageBuilderAssembleUpload(
+            self.task.id,
+            name,
+            streams,
+            self.blocksize,
+            size if sparse else length,
+            checksum.hexdigest(),
+            extents,
+        )
+
+        if sparse:
+            logger.info(
+                "uploaded %d of %d bytes of sparse file %s", length, size, name
+            )
+
+            return file_checksum.hexdigest(), size
+
+        return checksum.hexdigest(), length
+
+    def read_blocks(self, f, extents=None, size=None, checksum=None):
+        """Read a file in blocks of `blocksize` bytes, only the last block is
+        shorter. Without `extents` the file is read until its end.
+
+        With the data `extents` of a sparse file only those are read. When a
+        checksum is passed it's updated with the contents of the whole file,
+        including the holes."""
+
+        if extents is None:
+            ranges = [(None, None)]
+        else:
+            ranges = extents + [(size, 0)]
+
+        buffer, filled, position = self.buffer(), 0, 0
+
+        for offset, length in ranges:
+            if offset is not None:
+                if checksum is not None:
+                    hash_zeros(checksum, offset - position)
+
+                f.seek(offset)
+                position = offset + length
+
+            while length is None or length > 0:
+                end = self.blocksize
+
+                if length is not None:
+                    end = min(end, filled + length)
+
+                with memoryview(buffer) as view:
+                    read = f.readinto(view[filled:end])
+
+                    if checksum is not None:
+                        checksum.update(view[filled:filled + read])
+
+                if not read:
+                    if length is None:
+                        break
+
+                    raise koji.GenericError(f"{f.name} changed while uploading")
+
+                filled += read
+
+                if length is not None:
+                    length -= read
+
+                if filled == self.blocksize:
+                    yield buffer, filled
+                    buffer, filled = self.buffer(), 0
+
+        if filled:
+            yield buffer, filled
+        else:
+            self.buffers.put(buffer)
+
+    def upload_stream(self, session, chunks, name, failed):
+        """Upload the chunks from a queue to a single file on the hub until a
+        `None` is received. When any of the streams fails the remaining chunks
+        are drained without uploading them."""
+
+        offset = 0
+        error = None
+
+        while True:
+            item = chunks.get()
+
+            if item is None:
+                break
+
+            buffer, size = item
+
+            try:
+                if not failed.is_set():
+                    with memoryview(buffer) as view:
+                        self.upload_chunk(session, view[:size], offset, name)
+
+                    offset += size
+            except Exception as e:
+                error = e
+                failed.set()
+            finally:
+                self.buffers.put(buffer)
+
+        if error is not None:
+            raise error
+
+        # Streams that didn't get any data still need their part file on the
+        # hub, this happens for sparse files that are (almost) all holes.
+        if not offset and not failed.is_set():
+            self.upload_chunk(session, b"", 0, name)
+
+    def submit(self, path, name):
+        """Upload a file, in pipelined mode this returns before the upload is
+        done."""
+
+        compress = None
+
+        if self.compress is not None and name.endswith(COMPRESSIBLE):
+            compress = self.compress
+            name = f"{name}.{COMPRESSORS[compress][0]}"
+
+        # Files with the same name would overwrite each other on the hub.
+        if name in self.files:
+            raise koji.GenericError(f"more than one artifact is named {name}")
+
+        self.files.append(name)
+
+        # Sessions are created from the task's session, in pipelined mode that
+        # can't happen in the background while the task is using it.
+        if self.striped(path, compress) and not self.stream_sessions:
+            self.stream_sessions = [
+                self.task.session.subsession() for _ in range(max(self.streams, 1))
+            ]
+
+        if self.executor is None:
+            self.upload(path, name, compress)
+        else:
+            self.futures.append(
+                self.executor.submit(self.upload, path, name, compress)
+            )
+
+    def striped(self, path, compress=None):
+        """Whether a file is uploaded over multiple connections, which is the
+        case for large files and for sparse files."""
+
+        stat = os.stat(path)
+
+        if compress is None and self.sparse and stat.st_blocks * 512 < stat.st_size:
+            return True
+
+        return self.streams > 1 and stat.st_size >= self.min_size
+
+    def submit_tree(self, path):
+        """Upload all files below `path` that weren't uploaded before."""
+
+        for root, _, files in os.walk(path):
+            for file in sorted(files):
+                full = os.path.join(root, file)
+
+                if full in self.seen:
+                    continue
+
+                self.seen.add(full)
+                self.submit(full, file)
+
+    def wait(self):
+        """Wait for all uploads to be done, raises the first error that
+        happened during an upload."""
+
+        futures, self.futures = self.futures, []
+
+        for future in futures:
+            future.result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+        if self.stream_executor is not None:
+            self.stream_executor.shutdown(wait=True, cancel_futures=True)
+            self.stream_executor = None
+
+        for session in [self.session] + self.stream_sessions:
+            if session is not None:
+                session.logout()
+
+        self.session = None
+        self.stream_sessions = []
+
+
 class ImageBuilderBuildTask(BuildImageTask):
     """Spawns imageBuilderBuildArch tasks."""
 
@@ -126,11 +1363,35 @@ class ImageBuilderBuildTask(BuildImageTask):
     ):
         self.opts = {} if opts is None else opts
 
-        target_info = self.session.getBuildTarget(target, strict=True)
+        # Manifests are only there to validate a configuration, they are never
+        # imported into a build.
+        if self.opts.get("manifest_only"):
+            self.opts["scratch"] = True
+
+        if not self.opts.get("scratch"):
+            self.opts["scratch"] = False
+
+        if self.opts.get("version"):
+            version = self.opts["version"]
+
+        # The build target and the release don't depend on each other and are
+        # looked up in a single round trip to the hub.
+        with self.session.multicall(strict=True) as m:
+            target_call = m.getBuildTarget(target, strict=True)
+
+            if not self.opts.get("release"):
+                release_call = m.getNextRelease({"name": name, "version": version})
+
+        target_info = target_call.result
 
         if target_info is None:
             raise koji.BuildError(f"target '{target}' not found")
 
+        if self.opts.get("release"):
+            release = self.opts["release"]
+        else:
+            release = release_call.result
+
         build_tag_id = target_info["build_tag"]
         build_config = self.session.getBuildConfig(build_tag_id)
 
@@ -150,20 +1411,7 @@ class ImageBuilderBuildTask(BuildImageTask):
                     "Unsupported architecture(s): " + str(diff)
                 )
 
-        repo_info = self.getRepo(build_tag_id)
-
-        if not self.opts.get("scratch"):
-            self.opts["scratch"] = False
-
-        if self.opts.get("version"):
-            version = self.opts["version"]
-
-        if self.opts.get("release"):
-            release = self.opts["release"]
-        else:
-            release = self.session.getNextRelease(
-                {"name": name, "version": version}
-            )
+        repo_info = self.getRepo(build_tag_id)
 
         if not self.opts["scratch"]:
             build_info = self.initImageBuild(
@@ -175,36 +1423,54 @@ class ImageBuilderBuildTask(BuildImageTask):
             build_info = {}
 
         try:
-            subtasks = {}
-            canfails = []
-
-            for arch in arches:
-                subtasks[arch] = self.session.host.subtask(
-                    method="imageBuilderBuildArch",
-                    arglist=[
-                        name,
-                        version,
-                        release,
-                        arch,
-                        types,
-                        target_info,
-                        build_config,
-                        repo_info,
-                        self.opts,
-                    ],
-                    label=arch,
-                    parent=self.id,
-                    arch=arch,
+            # All architecture tasks are created in a single call to the hub.
+            with self.session.multicall(strict=True) as m:
+                calls = {
+                    arch: m.host.subtask(
+                        method="imageBuilderBuildArch",
+                        arglist=[
+                            name,
+                            version,
+                            release,
+                            arch,
+                            types,
+                            target_info,
+                            build_config,
+                            repo_info,
+                            self.opts,
+                        ],
+                        label=arch,
+                        parent=self.id,
+                        arch=arch,
+                    )
+                    for arch in arches
+                }
+
+            subtasks = {arch: call.result for arch, call in calls.items()}
+            canfails = [
+                task_id
+                for arch, task_id in subtasks.items()
+                if arch in self.opts.get("failable_arches", [])
+            ]
+
+            # As soon as an architecture that isn't allowed to fail fails the
+            # remaining subtasks are cancelled, the build can't succeed anymore
+            # and their builders are better used for something else.
+            try:
+                results = self.wait(
+                    list(subtasks.values()),
+                    all=True,
+                    failany=True,
+                    canfail=canfails,
                 )
+            except koji.GenericError as e:
+                cancelled = self.cancelled_subtasks(subtasks)
 
-                if arch in self.opts.get("failable_arches", []):
-                    canfails.append(subtasks[arch])
+                if not cancelled:
+                    raise
 
-            results = self.wait(
-                list(subtasks.values()),
-                all=True,
-                canfail=canfails,
-            )
+                # Keep the class of the subtask's error, such as a `BuildError`.
+                raise type(e)(f"{e} ({cancelled})") from e
 
             all_failed = True
 
@@ -266,13 +1532,322 @@ class ImageBuilderBuildTask(BuildImageTask):
         report += "image build results in: %s" % respath
         return report
 
+    def cancelled_subtasks(self, subtasks):
+        """Describe the subtasks that were cancelled after another subtask
+        failed, and the weight they freed up on their builders."""
+
+        with self.session.multicall(strict=True) as m:
+            infos = {
+                arch: m.getTaskInfo(task_id) for arch, task_id in subtasks.items()
+            }
+
+        cancelled = []
+        weight = 0
+
+        for arch, info in infos.items():
+            if info.result["state"] == koji.TASK_STATES["CANCELED"]:
+                cancelled.append(f"{arch} ({info.result['id']})")
+                weight += info.result["weight"] or 0
+
+        if not cancelled:
+            return None
+
+        logger.info(
+            "cancelled subtasks %s freeing a weight of %.2f",
+            ", ".join(cancelled),
+            weight,
+        )
+
+        return f"cancelled {', '.join(cancelled)}, freeing a weight of {weight:.2f}"
+
+
+# The weight of building a single image type, the first pattern that matches
+# the name of a type is used. Installers and live images build an image and then
+# an ISO around it, bootc types copy whole containers around.
+TYPE_WEIGHTS = [
+    (re.compile(r"installer|iso|dvd|live"), 2.0),
+    (re.compile(r"bootc|container"), 1.5),
+]
+
+DEFAULT_TYPE_WEIGHT = 1.0
+
+
+def type_weight(typ):
+    for pattern, weight in TYPE_WEIGHTS:
+        if pattern.search(typ):
+            return weight
+
+    return DEFAULT_TYPE_WEIGHT
+
 
 class ImageBuilderBuildArchTask(BaseBuildTask):
     _taskWeight = 0.2
 
     Methods = ["imageBuilderBuildArch"]
 
-    def handler(
+    # Locations inside the build root where host caches are mounted.
+    STORE_CACHE_DIR = "/builddir/cache/store"
+    DEPSOLVE_CACHE_DIR = "/builddir/cache/depsolve"
+    RPM_CACHE_DIR = f"{STORE_CACHE_DIR}/sources/org.osbuild.files"
+
+    def weight(self):
+        """Tasks have the default weight unless the build tag sets
+        `image_builder.task_weight`, either to a fixed weight or to `auto` to
+        compute it from the image types. Koji doesn't expect this to fail so
+        any error falls back to the default weight."""
+
+        try:
+            return self._weight()
+        except Exception:
+            logger.exception("could not determine task weight, using default")
+            return self._taskWeight
+
+    def _weight(self):
+        """The weight of a task depends on the image types that are built and
+        how many of them are built at the same time, whether containers or
+        ostree commits are involved, and how long the types took to build on
+        this host before."""
+
+        arch, types = self.params[3], self.params[4]
+        build_config = self.params[6]
+        opts = (self.params[8] if len(self.params) > 8 else None) or {}
+
+        extra = build_config["extra"]
+        task_weight = extra.get("image_builder.task_weight")
+
+        if task_weight is None:
+            return self._taskWeight
+
+        if task_weight != "auto":
+            return float(task_weight)
+
+        # Generating manifests is cheap regardless of the types.
+        if opts.get("manifest_only"):
+            return self._taskWeight
+
+        concurrent = int(extra.get("image_builder.max_concurrent_types", 1))
+
+        if extra.get("image_builder.single_invocation", False):
+            concurrent = 1
+
+        weights = sorted((type_weight(typ) for typ in types), reverse=True)
+        weight = sum(weights[:max(concurrent, 1)])
+
+        if opts.get("bootc") or opts.get("ostree"):
+            weight += 0.5
+
+        # Types that took long to build before get up to two extra, one for
+        # every hour.
+        metrics = Metrics.from_config(read_config())
+
+        if metrics is not None:
+            durations = [
+                metrics.average(
+                    "koji_image_builder_build_duration_seconds",
+                    {"arch": arch, "type": typ},
+                )
+                for typ in types
+            ]
+            durations = [d for d in durations if d is not None]
+
+            if durations:
+                weight += min(max(durations) / 3600, 2.0)
+
+        return weight
+
+    def handler(self, *args, **kwargs):
+        # The duration of each phase of the task is recorded in its profile.
+        self.profile = Profile()
+        self.broot = None
+        self.config = None
+
+        # Anything that needs to be cleaned up when the task is done, such as
+        # locks on host caches, is registered with `self.cleanup`.
+        with contextlib.ExitStack() as self.cleanup:
+            try:
+                data = self.build(*args, **kwargs)
+            except Exception:
+                # The profile of a failed task shows where it failed.
+                if self.broot is not None:
+                    try:
+                        self.upload_profile(self.broot)
+                    except Exception:
+                        logger.exception("failed to upload the profile")
+
+                self.write_metrics(failed=True)
+                raise
+
+            self.write_metrics(failed=False)
+
+            return data
+
+    def write_metrics(self, failed):
+        """Add the metrics of this task to those of the host when metrics are
+        configured. Problems with metrics never fail the task."""
+
+        if self.config is None:
+            return
+
+        try:
+            metrics = Metrics.from_config(self.config)
+
+            if metrics is None:
+                return
+
+            arch = self.arch
+            types = self.types
+
+            metrics.inc(
+                "koji_image_builder_tasks_total",
+                {"arch": arch, "result": "failure" if failed else "success"},
+            )
+
+            failed_phase = "other" if failed else None
+
+            for phase in self.profile.phases:
+                name = phase["name"]
+
+                # Phases per type or file are counted as a single phase.
+                if phase.get("failed"):
+                    failed_phase = re.sub(r"^(build|upload)-.*", r"\1", name)
+
+                if name == "build" or name.startswith("build-"):
+                    # Types that are built together are reported together.
+                    typ = ",".join(types)
+
+                    if name != "build":
+                        typ = name[len("build-"):]
+
+                    metrics.observe(
+                        "koji_image_builder_build_duration_seconds",
+                        {"arch": arch, "type": typ},
+                        phase["duration"],
+                    )
+                elif name == "container-pulls":
+                    metrics.observe(
+                        "koji_image_builder_container_pull_duration_seconds",
+                        {"arch": arch},
+                        phase["duration"],
+                    )
+                    metrics.inc(
+                        "koji_image_builder_container_pull_bytes_total",
+                        {"arch": arch},
+                        phase.get("size", 0),
+                    )
+                elif name.startswith("upload-"):
+                    metrics.inc(
+                        "koji_image_builder_upload_bytes_total",
+                        {"arch": arch},
+                        phase["size"],
+                    )
+                    metrics.inc(
+                        "koji_image_builder_upload_duration_seconds_total",
+                        {"arch": arch},
+                        phase["duration"],
+                    )
+
+            for cache, result in self.profile.caches.items():
+                metrics.inc(
+                    "koji_image_builder_cache_requests_total",
+                    {"cache": cache, "result": result},
+                )
+
+            if failed_phase:
+                metrics.inc(
+                    "koji_image_builder_failures_total",
+                    {"arch": arch, "phase": failed_phase},
+                )
+
+            metrics.write()
+        except Exception:
+            logger.exception("failed to write metrics")
+
+    def upload_profile(self, broot):
+        """Write the profile of the task next to its logs and upload it,
+        returns the name of the uploaded file."""
+
+        self.profile.parse_log(os.path.join(broot.resultdir(), "mock_output.log"))
+
+        path = os.path.join(broot.tmpdir(), "image-builder-profile.json")
+
+        self.profile.dump(path)
+        self.uploadFile(path)
+
+        return os.path.basename(path)
+
+    def acquire_cache(self, config, section, key, cache_class=HostCache):
+        """Lock an entry of a host cache for the duration of the task, returns
+        the path of the entry or `None` if the cache isn't available."""
+
+        cache = cache_class.from_config(config, section)
+
+        if cache is None:
+            return None
+
+        entry = cache.acquire(key)
+
+        if entry is None:
+            self.profile.caches[section] = "busy"
+            return None
+
+        path, release = entry
+        self.cleanup.callback(release)
+
+        # An entry that already has contents is a hit.
+        self.profile.caches[section] = "hit" if os.listdir(path) else "miss"
+
+        return path
+
+    def enable_root_cache(self, broot, path):
+        """Configure the `root_cache` plugin of `mock` for a build root, this
+        has to happen before it is initialized."""
+
+        # `kojid` writes a new configuration for every build root, the cache
+        # has to be used regardless of it being older than the configuration.
+        lines = [
+            "config_opts['plugin_conf']['root_cache_enable'] = True",
+            f"config_opts['plugin_conf']['root_cache_opts']['dir'] = {path!r}",
+            "config_opts['plugin_conf']['root_cache_opts']['age_check'] = False",
+        ]
+
+        with open(os.path.join(MOCK_CONFIG_DIR, f"{broot.mockcfg}.cfg"), "a") as f:
+            f.write("\n".join(lines) + "\n")
+
+        logger.info("using build root cache in %s", path)
+
+    def mount_local_repo(self, broot, topdir, repo):
+        """Mount a repository in the koji topdir and the packages it links to
+        into a build root at the same paths as on the host. The `bind_mount`
+        plugin of `mock` can't mount read-only, the mounts are added to the
+        `mount` plugin with explicit options instead. This has to happen
+        before the build root is initialized."""
+
+        paths = [repo, os.path.join(topdir, "packages")]
+
+        # Packages of builds on other volumes are linked through these.
+        volumes = os.path.join(topdir, "vol")
+
+        if os.path.isdir(volumes):
+            paths.extend(
+                os.path.join(volumes, name, "packages")
+                for name in sorted(os.listdir(volumes))
+            )
+
+        lines = ["config_opts['plugin_conf']['mount_enable'] = True"]
+
+        for path in paths:
+            if os.path.isdir(path):
+                lines.append(
+                    "config_opts['plugin_conf']['mount_opts']['dirs'].append("
+                    f"({path!r}, {path!r}, 'none', 'bind,ro'))"
+                )
+
+        with open(os.path.join(MOCK_CONFIG_DIR, f"{broot.mockcfg}.cfg"), "a") as f:
+            f.write("\n".join(lines) + "\n")
+
+        logger.info("mounting local repository %s read-only", repo)
+
+    def build(
         self,
         name,
         version,
@@ -285,9 +1860,13 @@ class ImageBuilderBuildArchTask(BaseBuildTask):
         opts=None,
     ):
         self.opts = {} if opts is None else opts
+        self.arch = arch
+        self.types = types
 
         build_tag_id = target_info["build_tag"]
 
+        config = self.config = read_config()
+
         # When running in "simple" or "old" mock isolation modes we need to
         # request `mock` to mount `/dev` for us. We don't *always* need access
         # to `/dev` as it's dependent on the image types being built, but it
@@ -297,6 +1876,137 @@ class ImageBuilderBuildArchTask(BaseBuildTask):
         if not build_config["extra"].get("mock.new_chroot", True):
             bind_opts = {"dirs": {"/dev": "/dev"}}
 
+        # Set up repositories that are being used. If there were optional
+        # repos provided we use those, otherwise we use the targets repo
+        repos = []
+        local_repo = None
+
+        for repo in self.opts.get("repos", []):
+            # Note the manual DNF variable replacement here, this is to
+            # work around an underlying issue in the dependency solver used
+            # by `osbuild` and a fix is underway in `osbuild` itself; however
+            # because the plugin is disconnected dependency wise from the
+            # buildroot we also apply replacement here, naively.
+            repo = repo.replace("$arch", arch)
+            repo = repo.replace("$basearch", arch)
+
+            repos.append(repo)
+
+        if repos:
+            repos_key = hashlib.sha256(json.dumps(repos).encode()).hexdigest()
+            repos_key = f"repos-{repos_key[:16]}"
+        else:
+            # Builders that have the koji topdir mounted can read the build tag
+            # repository from it instead of going through the web frontend.
+            # Only the repository and the packages it links to are mounted
+            # into the build root, read-only.
+            topdir = self.options.topdir
+            local = target_repo(topdir, target_info, repo_info).replace("$arch", arch)
+            local_topdir = config.getboolean("repos", "local_topdir", fallback=False)
+
+            if local_topdir and os.path.isdir(local):
+                local_repo = os.path.dirname(local)
+                repos.append("file://" + target_repo(topdir, target_info, repo_info))
+            else:
+                repos.append(target_repo(self.options.topurl, target_info, repo_info))
+
+            repos_key = f"{target_info['build_tag_name']}-{repo_info['id']}"
+
+        output_name = f"{name}-{version}-{release}.{arch}"
+
+        # Uncompressed disk images and archives can be compressed on their
+        # way to the hub, the task option takes precedence over the build tag.
+        compress = self.opts.get(
+            "compress", build_config["extra"].get("image_builder.compress")
+        )
+
+        # Builds with a fixed seed from the same inputs produce equivalent
+        # images. The artifacts of such builds are kept on the host and are
+        # reused when the same inputs are built again.
+        digest = self.input_digest(types, arch, target_info, repo_info)
+        artifacts = None
+
+        if digest:
+            artifacts = self.acquire_cache(config, "artifact_cache", digest)
+
+        if artifacts and os.path.exists(os.path.join(artifacts, "artifacts.json")):
+            uploader = ArtifactUploader.from_config(
+                self, config, compress, self.profile
+            )
+            self.cleanup.callback(uploader.close)
+
+            previous = self.reuse_artifacts(artifacts, output_name, uploader)
+
+            return {
+                "task_id": self.id,
+                "name": name,
+                "version": version,
+                "release": release,
+                "arch": arch,
+                "files": uploader.files,
+                "logs": [],
+                "rpmlist": [],
+                "file_info": uploader.file_info,
+                "reused": {"digest": digest, "task_id": previous["task_id"]},
+                "profile": self.profile.summary(),
+            }
+
+        # In manifest only mode `image-builder` stops after depsolving and
+        # generating the manifest, nothing is downloaded or built. Only the
+        # depsolve cache is used, the other caches are left to real builds.
+        manifest_only = self.opts.get("manifest_only", False)
+
+        # The `osbuild` store contains the results of pipelines and stages. We
+        # keep it around between tasks on the same host so repeated builds
+        # against the same repository can reuse its contents. When the repo
+        # changes we start with a fresh store.
+        store = None
+
+        if not manifest_only:
+            store = self.acquire_cache(
+                config,
+                "store_cache",
+                f"{target_info['build_tag_name']}-{repo_info['id']}-{arch}",
+            )
+
+        if store:
+            bind_opts.setdefault("dirs", {})[store] = self.STORE_CACHE_DIR
+
+        # The RPMs that go into images are downloaded into the sources of the
+        # `osbuild` store, which are addressed by their checksum. These are
+        # shared by all tasks on the host regardless of the repository, as
+        # `osbuild` only adds sources with atomic renames concurrent tasks can
+        # safely fill the same directory.
+        rpms = None
+
+        if not manifest_only:
+            rpms = self.acquire_cache(config, "rpm_cache", "rpms", SharedHostCache)
+
+        if rpms:
+            bind_opts.setdefault("dirs", {})[rpms] = self.RPM_CACHE_DIR
+
+        # The repository metadata and the solver data that is generated from
+        # it during depsolving are cached by the repositories that are used. A
+        # new repository from `kojira` has a new id and thus a new entry.
+        depsolve = self.acquire_cache(
+            config, "depsolve_cache", f"{repos_key}-{arch}"
+        )
+
+        if depsolve:
+            bind_opts.setdefault("dirs", {})[depsolve] = self.DEPSOLVE_CACHE_DIR
+
+        # Containers for bootc builds are pulled into container storage that
+        # is kept between tasks, only layers that aren't available locally are
+        # downloaded. Each task uses its own slot so `podman` in different
+        # build roots never shares the same storage at the same time.
+        containers = None
+
+        if self.opts.get("bootc") and not manifest_only:
+            containers = self.acquire_cache(config, "container_cache", "storage")
+
+        if containers:
+            bind_opts.setdefault("dirs", {})[containers] = "/var/lib/containers/storage"
+
         broot = BuildRoot(
             self.session,
             self.options,
@@ -309,10 +2019,39 @@ class ImageBuilderBuildArchTask(BaseBuildTask):
             bind_opts=bind_opts,
         )
 
+        # An initialized build root is kept between tasks with the `root_cache`
+        # plugin of `mock`. It's a snapshot of the build root after the install
+        # group was installed, later tasks unpack it instead of installing all
+        # packages again. A new repository starts a new entry.
+        root_cache = None
+
+        if not manifest_only:
+            root_cache = self.acquire_cache(
+                config,
+                "buildroot_cache",
+                f"{target_info['build_tag_name']}-{repo_info['id']}-{arch}",
+            )
+
+        if root_cache:
+            self.enable_root_cache(broot, root_cache)
+
+        if local_repo:
+            self.mount_local_repo(broot, self.options.topdir, local_repo)
+
         broot.workdir = self.workdir
-        broot.init()
 
-        cmd = []
+        with self.profile.phase("buildroot-init"):
+            broot.init()
+
+        self.broot = broot
+
+        # Logs of the task, other than those produced by `mock` itself.
+        logs = []
+
+        # Commands that need to run under the `mock` compatibility wrapper are
+        # prefixed with `wrapper`.
+        wrapper = []
+        start = time.monotonic()
 
         if not build_config["extra"].get("mock.new_chroot", True):
             # We're going to write a wrapper into the mock. Since `image-builder`
@@ -333,7 +2072,7 @@ class ImageBuilderBuildArchTask(BaseBuildTask):
             with open(os.path.join(path, "mock-wrap"), "w") as f:
                 f.write(MOCK_SIMPLE_WRAPPER)
 
-            cmd.extend(
+            wrapper.extend(
                 ["sh", os.path.join(broot.tmpdir(within=True), "mock-wrap")]
             )
         else:
@@ -346,22 +2085,30 @@ class ImageBuilderBuildArchTask(BaseBuildTask):
                 "on the build tag"
             )
 
+        self.profile.add("wrapper-setup", start, time.monotonic() - start)
+
         # The base command to start with, we want to do a build and we want to
         # be verbose during the build. This disables progress bars and other
         # fancy terminal output.
-        cmd.extend(
-            [
-                "image-builder",
-                "-v",
-                "build",
-            ]
-        )
+        cmd = [
+            "image-builder",
+            "-v",
+            "manifest" if manifest_only else "build",
+        ]
+
+        # The depsolver in `image-builder` keeps its cache in the user cache
+        # directory.
+        if depsolve:
+            cmd[:0] = ["env", f"XDG_CACHE_HOME={self.DEPSOLVE_CACHE_DIR}"]
 
         # We turn off `librepo` fetching, there are some bugs regarding
         # variable replacements and it's not doing anything useful within the
         # koji environment. See issue: https://github.com/osbuild/image-builder-cli/issues/151
         cmd.extend(["--use-librepo=false"])
 
+        if (store or rpms) and not manifest_only:
+            cmd.extend(["--cache", self.STORE_CACHE_DIR])
+
         # When an optional `data_url` is present we check it out into the
         # the build root and pass it on to `image-builder`. This allows for
         # overriding built-in definitions to those present in the repository.
@@ -396,37 +2143,19 @@ class ImageBuilderBuildArchTask(BaseBuildTask):
         if distro:
             cmd.extend(["--distro", distro])
 
-        # Set up repositories that are being used. If there were optional
-        # repos provided we use those, otherwise we use the targets repo
-        repos = self.opts.get("repos", [])
-        if repos:
-            for repo in repos:
-                # Note the manual DNF variable replacement here, this is to
-                # work around an underlying issue in the dependency solver used
-                # by `osbuild` and a fix is underway in `osbuild` itself; however
-                # because the plugin is disconnected dependency wise from the
-                # buildroot we also apply replacement here, naively.
-                repo = repo.replace("$arch", arch)
-                repo = repo.replace("$basearch", arch)
-
-                cmd.extend(["--force-repo", repo])
-        else:
+        for repo in repos:
+            cmd.extend(["--force-repo", repo])
+
+        # We also want most of the extra information we can get out of
+        # `image-builder`, the more the better in this case.
+        if not manifest_only:
             cmd.extend(
                 [
-                    "--force-repo",
-                    target_repo(self.options.topurl, target_info, repo_info),
+                    "--with-sbom",
+                    "--with-manifest",
                 ]
             )
 
-        # We also want most of the extra information we can get out of
-        # `image-builder`, the more the better in this case.
-        cmd.extend(
-            [
-                "--with-sbom",
-                "--with-manifest",
-            ]
-        )
-
         # If ostree information is available pass it on to the command
         ostree = self.opts.get("ostree")
         if ostree:
@@ -459,20 +2188,68 @@ class ImageBuilderBuildArchTask(BaseBuildTask):
                 "installer-payload-ref": "--installer-payload-ref",
             }
 
+            # We need to pull the containers into local storage, this requires
+            # the podman executable to be available in our buildroot. With
+            # shared container storage we only pull when the digest the ref
+            # points to isn't already available.
+            pulls = {}
+
             for opt in opt_to_arg:
                 bootc_ref = bootc.get(opt)
                 if bootc_ref:
                     cmd.extend([opt_to_arg[opt], bootc_ref])
 
-                    # We need to pull the container into local storage, this
-                    # requires the podman executable to be available in our buildroot
-                    exit_code = broot.mock(
-                        ["--cwd", broot.tmpdir(within=True), "--chroot", "--",
-                         "podman", "pull", bootc_ref]
+                    pull = ["podman", "pull", bootc_ref]
+
+                    if containers:
+                        pull[2:2] = ["--policy=newer"]
+
+                    pulls[f"pull-{opt}"] = pull
+
+            # All containers are pulled at the same time, as soon as one of
+            # the pulls fails the others are cancelled.
+            if pulls:
+                # The layers that were added to container storage are the
+                # data that was pulled. Reading the layer list takes no time
+                # worth mentioning compared to the pulls themselves.
+                storage = containers or os.path.join(
+                    broot.rootdir(), "var/lib/containers/storage"
+                )
+                before = container_layers(storage)
+
+                with self.profile.phase("container-pulls") as phase:
+                    statuses = self.run_parallel(
+                        broot, [], pulls, len(pulls), failfast=True
                     )
 
-                    if exit_code != 0:
-                        raise koji.GenericError(f"`podman` failed to pull container {ref}: {bootc_ref}")
+                    phase["size"] = sum(
+                        size
+                        for layer, size in container_layers(storage).items()
+                        if layer not in before
+                    )
+
+                for job, status in statuses.items():
+                    log = os.path.join(broot.tmpdir(), f"{job}.log")
+
+                    if os.path.exists(log):
+                        self.uploadFile(log)
+                        logs.append(os.path.basename(log))
+
+                    logger.info(
+                        "%s: %s",
+                        job,
+                        "cancelled" if status is None else f"exited with {status}",
+                    )
+
+                for job, status in statuses.items():
+                    if status not in (0, None):
+                        opt = job[len("pull-"):]
+                        raise koji.GenericError(
+                            f"`podman` failed to pull container {opt}: {bootc[opt]}"
+                        )
+
+                if None in statuses.values():
+                    raise koji.GenericError("`podman` failed to pull containers")
 
             # image-builder tries to determine the root filesystem to use based
             # on container metadata and/or contents, for some containers this isnt'
@@ -492,30 +2269,157 @@ class ImageBuilderBuildArchTask(BaseBuildTask):
         if preview is not None:
             cmd.extend(["--preview", "true" if preview else "false"])
 
-        cmd.extend(["--output-dir", "/builddir/output"])
-        cmd.extend(["--output-name", f"{name}-{version}-{release}.{arch}"])
-
         # And execute it. The exception message here might look very terse
         # however all output from the build root is logged and attached as log
         # files to the task.
 
-        # We execute one time for each image type that's requested, in the
-        # future `image-builder` will likely grow support to output multiple
-        # types at the same time and we will adjust the code as necessary.
-
-        # This is mostly useful for scratch builds as it reduces build time
-        # by quite a lot since `image-builder` does a lot of caching between
-        # pipelines.
-
         # Pungi does not yet understand multiple artifacts in a single build
         # so for composes we'll always receive a single type.
 
-        for typ in types:
-            exit_code = broot.mock(
-                ["--cwd", broot.tmpdir(within=True), "--chroot", "--"] + cmd + [typ]
-            )
+        max_concurrent_types = int(
+            build_config["extra"].get("image_builder.max_concurrent_types", 1)
+        )
+
+        failed_types = []
+
+        output = os.path.join(broot.rootdir(), "builddir/output")
+
+        # All files that are in the output directory generated by
+        # `image-builder` are attached to the task. When pipelined uploads are
+        # enabled we start uploading the artifacts of an image type while the
+        # next type is being built.
+        uploader = ArtifactUploader.from_config(
+            self, config, compress, self.profile
+        )
+        self.cleanup.callback(uploader.close)
+
+        if manifest_only:
+            # The manifest of each type is written to the output directory,
+            # these contain the packages that the depsolve resulted in. All
+            # types are done at the same time as this only takes seconds.
+            jobs = {}
+
+            for typ in types:
+                manifest = f"/builddir/output/{output_name}.{typ}.manifest.json"
+
+                jobs[f"manifest-{typ}"] = [
+                    "sh",
+                    "-c",
+                    f"{shlex.join(cmd + [typ])} > {shlex.quote(manifest)}",
+                ]
+
+            koji.ensuredir(output)
+
+            with self.profile.phase("manifest"):
+                statuses = self.run_parallel(broot, wrapper, jobs, len(jobs))
+
+            for typ in types:
+                log = os.path.join(broot.tmpdir(), f"manifest-{typ}.log")
+
+                if os.path.exists(log):
+                    self.uploadFile(log)
+                    logs.append(os.path.basename(log))
+
+                if statuses[f"manifest-{typ}"] != 0:
+                    failed_types.append(typ)
+        elif build_config["extra"].get("image_builder.single_invocation", False):
+            # Newer versions of `image-builder` can build multiple image types
+            # in one invocation. This means the depsolve, package downloads,
+            # and any pipelines the types have in common are only done once.
+            # Since this depends on the `image-builder` version in the build
+            # root it is opt-in through the build tag.
+            # Types share the names of some of their outputs, such as those of
+            # the manifest and the SBOM. Without an output name the outputs of
+            # each type are named after the type, they are renamed to the
+            # output name of their type afterwards.
+            names = ["--output-name", output_name] if len(types) == 1 else []
+
+            with self.profile.phase("build"):
+                exit_code = broot.mock(
+                    ["--cwd", broot.tmpdir(within=True), "--chroot", "--"]
+                    + wrapper
+                    + cmd
+                    + ["--output-dir", "/builddir/output"]
+                    + names
+                    + list(types)
+                )
+                if exit_code != 0:
+                    raise koji.GenericError("`image-builder` failed")
+
+            if len(types) > 1:
+                self.rename_outputs(output, output_name, arch, types)
+        elif max_concurrent_types > 1 and len(types) > 1:
+            # Build the image types at the same time, each into its own output
+            # directory and with its own log. A failing type does not stop the
+            # other types from being built. Types share the names of some of
+            # their outputs, such as those of the manifest and the SBOM, so
+            # each type also gets its own output name.
+            jobs = {}
+
+            for typ in types:
+                jobs[f"build-{typ}"] = (
+                    cmd
+                    + ["--output-dir", f"/builddir/output/{typ}"]
+                    + ["--output-name", f"{output_name}.{typ}"]
+                    + [typ]
+                )
+
+            with self.profile.phase("build"):
+                statuses = self.run_parallel(
+                    broot, wrapper, jobs, max_concurrent_types
+                )
+
+            for typ in types:
+                log = os.path.join(broot.tmpdir(), f"build-{typ}.log")
+
+                if os.path.exists(log):
+                    self.uploadFile(log)
+                    self.profile.parse_log(log)
+                    logs.append(os.path.basename(log))
+
+                if statuses[f"build-{typ}"] != 0:
+                    failed_types.append(typ)
+        else:
+            # Otherwise we execute one time for each image type that's
+            # requested. With multiple types each type is built into its own
+            # output directory and with its own output name, so a type never
+            # writes to the outputs of a type before it while those are being
+            # uploaded.
+            for typ in types:
+                output_dir, type_output_name = "/builddir/output", output_name
+
+                if len(types) > 1:
+                    output_dir = f"/builddir/output/{typ}"
+                    type_output_name = f"{output_name}.{typ}"
+
+                with self.profile.phase(f"build-{typ}"):
+                    exit_code = broot.mock(
+                        ["--cwd", broot.tmpdir(within=True), "--chroot", "--"]
+                        + wrapper
+                        + cmd
+                        + ["--output-dir", output_dir]
+                        + ["--output-name", type_output_name]
+                        + [typ]
+                    )
+                    if exit_code != 0:
+                        raise koji.GenericError("`image-builder` failed")
+
+                uploader.submit_tree(
+                    os.path.join(broot.rootdir(), output_dir.lstrip("/"))
+                )
+
+        # Images that were replaced by a newer pull of the same ref are no
+        # longer tagged, remove them so the shared container storage only
+        # keeps the containers that are currently in use.
+        if containers:
+            with self.profile.phase("container-prune"):
+                exit_code = broot.mock(
+                    ["--cwd", broot.tmpdir(within=True), "--chroot", "--",
+                     "podman", "image", "prune", "--force"]
+                )
+
             if exit_code != 0:
-                raise koji.GenericError("`image-builder` failed")
+                logger.warning("failed to prune unused container images")
 
         # We have done our build, now it is time to massage our outputs into
         # the correct formats that koji understands and to make sure we give
@@ -528,20 +2432,206 @@ class ImageBuilderBuildArchTask(BaseBuildTask):
             "version": version,
             "release": release,
             "arch": arch,
-            "files": [],
-            "logs": [],
+            "files": uploader.files,
+            "logs": logs,
             "rpmlist": [],
+            # The sha256 and size of every file that was uploaded by the
+            # uploader itself, for consumers of the task result. Files that were compressed during
+            # upload also list their compression. Note that the import of the
+            # build on the hub does not use these, it still reads every file
+            # to compute its checksum.
+            "file_info": uploader.file_info,
         }
 
-        output = os.path.join(broot.rootdir(), "builddir/output")
+        # Upload anything that wasn't uploaded yet and make sure all uploads
+        # are done before we finish.
+        with self.profile.phase("finish-uploads"):
+            uploader.submit_tree(output)
+            uploader.wait()
+
+        # Only fail after all the image types that did succeed have been
+        # uploaded, so their artifacts remain available in the task output.
+        if failed_types:
+            raise koji.GenericError(
+                "`image-builder` failed for: " + ", ".join(failed_types)
+            )
 
-        # Attach and upload all files that are in the output directory generated
-        # by `image-builder`.
-        for root, _, files in os.walk(output):
-            for file in files:
-                self.uploadFile(os.path.join(root, file), remoteName=file)
-                data["files"].append(file)
+        if artifacts:
+            self.store_artifacts(artifacts, output, output_name)
+
+        # The profile is attached next to the logs, a summary of it is part of
+        # the result.
+        logs.append(self.upload_profile(broot))
+        data["profile"] = self.profile.summary()
 
         broot.expire()
 
         return data
+
+    def rename_outputs(self, output, output_name, arch, types):
+        """Rename the outputs of a single `image-builder` invocation for
+        multiple types. Without an output name these are named
+        `<distro>-<type>-<arch>`, each is renamed to `<output_name>.<type>`
+        and moved to the top of `output`. Outputs that don't belong to any of
+        the types keep their name."""
+
+        for root, _, files in list(os.walk(output)):
+            for file in files:
+                matches = [typ for typ in types if f"-{typ}-{arch}" in file]
+
+                if not matches:
+                    continue
+
+                # A type can end in another type, such as `minimal-raw` and
+                # `raw`, the outputs belong to the longest one.
+                typ = max(matches, key=len)
+                suffix = file[file.index(f"-{typ}-{arch}") + len(f"-{typ}-{arch}"):]
+
+                os.rename(
+                    os.path.join(root, file),
+                    os.path.join(output, f"{output_name}.{typ}{suffix}"),
+                )
+
+    def input_digest(self, types, arch, target_info, repo_info):
+        """A digest of all inputs of a build, or `None` when the output of the
+        build isn't determined by its inputs alone. That is the case without a
+        seed, with repositories or containers whose contents can change, and
+        for ostree builds."""
+
+        if self.opts.get("seed") is None or self.opts.get("manifest_only"):
+            return None
+
+        if self.opts.get("repos") or self.opts.get("ostree"):
+            return None
+
+        bootc = self.opts.get("bootc", {})
+
+        for opt in ("ref", "build-ref", "installer-payload-ref"):
+            if bootc.get(opt) and "@sha256:" not in bootc[opt]:
+                return None
+
+        inputs = {
+            "build_tag": target_info["build_tag"],
+            "repo_id": repo_info["id"],
+            "arch": arch,
+            "types": sorted(types),
+            "blueprint": self.opts.get("blueprint"),
+            "distro": self.opts.get("distro"),
+            "bootc": bootc,
+            "seed": self.opts["seed"],
+            "preview": self.opts.get("preview"),
+        }
+
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def store_artifacts(self, path, output, output_name):
+        """Keep the artifacts in `output` in an artifact cache entry. Files are
+        hardlinked when the cache is on the same filesystem as the build
+        root."""
+
+        files = os.path.join(path, "files")
+
+        # Leftovers of a task that failed while storing its artifacts.
+        if os.path.exists(files):
+            shutil.rmtree(files)
+
+        for root, _, names in os.walk(output):
+            for name in names:
+                source = os.path.join(root, name)
+                dest = os.path.join(files, os.path.relpath(source, output))
+
+                koji.ensuredir(os.path.dirname(dest))
+
+                try:
+                    os.link(source, dest)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+
+                    shutil.copy2(source, dest)
+
+        # The artifacts are only reused once this file exists.
+        with open(os.path.join(path, "artifacts.json.tmp"), "w") as f:
+            json.dump({"task_id": self.id, "output_name": output_name}, f)
+
+        os.rename(
+            os.path.join(path, "artifacts.json.tmp"),
+            os.path.join(path, "artifacts.json"),
+        )
+
+        logger.info("stored artifacts in %s", path)
+
+    def reuse_artifacts(self, path, output_name, uploader):
+        """Upload the artifacts of a previous build from an artifact cache
+        entry. Files are renamed from the output name of the previous build to
+        that of this build."""
+
+        with open(os.path.join(path, "artifacts.json")) as f:
+            previous = json.load(f)
+
+        for root, _, names in os.walk(os.path.join(path, "files")):
+            for name in sorted(names):
+                remote = name
+
+                if name.startswith(previous["output_name"]):
+                    remote = output_name + name[len(previous["output_name"]):]
+
+                uploader.submit(os.path.join(root, name), remote)
+
+        uploader.wait()
+
+        logger.info(
+            "reused artifacts of task %s from %s", previous["task_id"], path
+        )
+
+        return previous
+
+    def run_parallel(self, broot, wrapper, jobs, max_jobs, failfast=False):
+        """Run the commands in `jobs` (a mapping of job name to command) inside
+        the build root, at most `max_jobs` at the same time. Output of each job
+        is written to `<name>.log` in the build root's temporary directory.
+
+        Returns a mapping of job name to exit status, jobs that were killed or
+        never started because of `failfast` have a status of `None`."""
+
+        path = broot.tmpdir()
+        koji.ensuredir(path)
+
+        with open(os.path.join(path, "parallel-run"), "w") as f:
+            f.write(MOCK_PARALLEL_RUNNER)
+
+        scripts = []
+
+        for name, cmd in jobs.items():
+            log = os.path.join(broot.tmpdir(within=True), f"{name}.log")
+
+            with open(os.path.join(path, f"{name}.sh"), "w") as f:
+                f.write(f"exec {shlex.join(cmd)} > {shlex.quote(log)} 2>&1\n")
+
+            scripts.append(os.path.join(broot.tmpdir(within=True), f"{name}.sh"))
+
+        exit_code = broot.mock(
+            ["--cwd", broot.tmpdir(within=True), "--chroot", "--"]
+            + wrapper
+            + [
+                "bash",
+                os.path.join(broot.tmpdir(within=True), "parallel-run"),
+                str(max_jobs),
+                "1" if failfast else "0",
+            ]
+            + scripts
+        )
+
+        if exit_code != 0 and not failfast:
+            raise koji.GenericError("running jobs in the build root failed")
+
+        statuses = {}
+
+        for name in jobs:
+            try:
+                with open(os.path.join(path, f"{name}.sh.status")) as f:
+                    statuses[name] = int(f.read().strip())
+            except FileNotFoundError:
+                statuses[name] = None
+
+        return statuses
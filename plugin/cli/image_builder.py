@@ -1,14 +1,30 @@
+import os
+import sys
 import json
+import time
 
+import koji
 import koji_cli.lib as kl
 from koji.plugin import export_cli
 
+# Calls per request when polling tasks in a multicall, and the longest time to
+# wait between polls while none of the watched tasks change.
+WATCH_BATCH = 100
+WATCH_MAX_INTERVAL = 120
+
+DONE_STATES = (
+    koji.TASK_STATES["CLOSED"],
+    koji.TASK_STATES["CANCELED"],
+    koji.TASK_STATES["FAILED"],
+)
+
 
 @export_cli
 def handle_image_builder_build(gopts, session, args):
     "[build] Build images through `image-builder`:"
 
     usage = "usage: %prog image-builder-build [options] <target> <name> <version> <type> [<type>...]"
+    usage += "\n       %prog image-builder-build [options] --from-file <file>"
     usage += (
         "\n(Specify the --help global option for a list of other help options)"
     )
@@ -129,12 +145,39 @@ def handle_image_builder_build(gopts, session, args):
         action="store_false",
     )
 
+    parser.add_option(
+        "--manifest-only",
+        action="store_true",
+        default=False,
+        help="Only generate the manifests of the images, implies --scratch",
+    )
+
+    parser.add_option(
+        "--compress",
+        choices=["zstd", "xz"],
+        help="Compress uncompressed disk images and archives while uploading them",
+    )
+
     # this way we have 'None' when not passed which gives the default behavior (e.g.
     # whatever is set on the distro) and true/false otherwise which always override
     parser.set_defaults(preview=None)
 
+    parser.add_option(
+        "--from-file",
+        dest="from_file",
+        help="Submit all builds listed in a YAML or JSON file, options given "
+        "on the command line apply to every build in the file",
+    )
+
     (opts, args) = parser.parse_args(args)
 
+    if opts.from_file:
+        if args:
+            parser.error("no arguments are accepted with --from-file")
+            assert False
+
+        return submit_builds(gopts, session, opts)
+
     if len(args) < 4:
         parser.error("incorrect number of arguments")
         assert False
@@ -149,6 +192,26 @@ def handle_image_builder_build(gopts, session, args):
         version,
     ]
 
+    task_opts = task_opts_from_options(opts)
+
+    task_id = session.imageBuilderBuild(
+        *task_args,
+        opts=task_opts,
+    )
+
+    return kl.watch_tasks(
+        session,
+        [task_id],
+        quiet=gopts.quiet,
+        poll_interval=gopts.poll_interval,
+        topurl=gopts.topurl,
+    )
+
+
+def task_opts_from_options(opts):
+    """Turn the parsed command line options into the options of an
+    `imageBuilderBuild` task."""
+
     ostree = {}
 
     if opts.ostree_parent:
@@ -206,15 +269,280 @@ def handle_image_builder_build(gopts, session, args):
     if opts.failable_arches:
         task_opts["failable_arches"] = opts.failable_arches
 
-    task_id = session.imageBuilderBuild(
-        *task_args,
-        opts=task_opts,
+    if opts.manifest_only:
+        task_opts["manifest_only"] = True
+
+    if opts.compress:
+        task_opts["compress"] = opts.compress
+
+    return task_opts
+
+
+def read_builds(path, defaults, arches=None):
+    """Read a list of builds from a YAML or JSON file. Each build has a
+    `target`, `name`, `version`, and `types`, optionally `arches`, and any
+    of the options of an `imageBuilderBuild` task. A `blueprint` can be a
+    path to a JSON file relative to the file. The `defaults` are used for
+    options that a build doesn't set, and `arches` for builds that don't
+    list their architectures.
+
+    Returns the builds in the form that `imageBuilderBuildBatch` expects."""
+
+    with open(path, "r") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+
+            specs = yaml.safe_load(f)
+        else:
+            specs = json.load(f)
+
+    if not isinstance(specs, list):
+        raise koji.GenericError(f"{path} does not contain a list of builds")
+
+    builds = []
+
+    for index, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            raise koji.GenericError(f"build {index} in {path} is not a mapping")
+
+        spec = dict(spec)
+
+        missing = [k for k in ("target", "name", "version", "types") if k not in spec]
+
+        if missing:
+            raise koji.GenericError(
+                f"build {index} in {path} is missing: {', '.join(missing)}"
+            )
+
+        # YAML reads unquoted versions as numbers, `42.10` would silently
+        # become `42.1`.
+        if not isinstance(spec["version"], str):
+            raise koji.GenericError(
+                f"build {index} in {path} has a version that is not a string,"
+                " quote it"
+            )
+
+        build = {
+            "target": spec.pop("target"),
+            "arches": spec.pop("arches", arches or []),
+            "types": spec.pop("types"),
+            "name": spec.pop("name"),
+            "version": spec.pop("version"),
+        }
+
+        blueprint = spec.get("blueprint")
+
+        if isinstance(blueprint, str):
+            with open(os.path.join(os.path.dirname(path), blueprint), "r") as f:
+                spec["blueprint"] = json.load(f)
+
+        build["opts"] = {**defaults, **spec}
+
+        builds.append(build)
+
+    return builds
+
+
+def submit_builds(gopts, session, opts):
+    """Submit all builds from a file in a single call and watch the tasks
+    that were created."""
+
+    builds = read_builds(
+        opts.from_file, task_opts_from_options(opts), opts.arches
     )
+    results = session.imageBuilderBuildBatch(builds)
 
-    return kl.watch_tasks(
+    task_ids = []
+    failed = False
+
+    for build, result in zip(builds, results):
+        nvr = f"{build['name']}-{build['version']}"
+
+        if isinstance(result, dict):
+            print(f"{nvr} ({build['target']}): {result['faultString']}", file=sys.stderr)
+            failed = True
+        else:
+            print(f"{nvr} ({build['target']}): task {result}")
+            task_ids.append(result)
+
+    rv = watch_builds(
         session,
-        [task_id],
+        task_ids,
         quiet=gopts.quiet,
         poll_interval=gopts.poll_interval,
-        topurl=gopts.topurl,
     )
+
+    if failed and not rv:
+        return 1
+
+    return rv
+
+
+def poll_builds(session, tasks):
+    """Fetch the state of the build tasks that haven't finished yet and the
+    state of their children in one multicall. `tasks` maps task ids to what
+    is known about them and is updated in place."""
+
+    pending = [t for t, task in tasks.items() if task["state"] not in DONE_STATES]
+
+    with session.multicall(strict=True, batch=WATCH_BATCH) as m:
+        calls = [
+            (
+                task_id,
+                m.getTaskInfo(task_id, request=tasks[task_id]["label"] is None),
+                m.getTaskChildren(task_id),
+            )
+            for task_id in pending
+        ]
+
+    for task_id, info, children in calls:
+        task = tasks[task_id]
+        info = info.result
+
+        if info is None:
+            raise koji.GenericError(f"No such task id: {task_id}")
+
+        if task["label"] is None:
+            request = info.get("request") or []
+            task["label"] = (
+                f"{request[3]}-{request[4]}" if len(request) > 4 else info["method"]
+            )
+
+        task["state"] = info["state"]
+        task["children"] = {
+            child["label"] or str(child["id"]): child for child in children.result
+        }
+
+
+def format_builds(tasks, task_ids):
+    """A table with a row for every task in `task_ids` and a column for the
+    state of every architecture (and the tag task)."""
+
+    columns = sorted({label for t in task_ids for label in tasks[t]["children"]})
+
+    rows = [["TASK", "BUILD", "STATE", *columns]]
+
+    for task_id in task_ids:
+        task = tasks[task_id]
+        children = task["children"]
+
+        rows.append(
+            [
+                str(task_id),
+                task["label"],
+                koji.TASK_STATES[task["state"]].lower(),
+                *(
+                    koji.TASK_STATES[children[c]["state"]].lower() if c in children else "-"
+                    for c in columns
+                ),
+            ]
+        )
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+def task_failures(session, tasks):
+    """The errors of the build tasks, and their children, that failed."""
+
+    failed = []
+
+    for task_id, task in tasks.items():
+        if task["state"] != koji.TASK_STATES["FAILED"]:
+            continue
+
+        failed.append((task_id, task["label"]))
+
+        for label, child in sorted(task["children"].items()):
+            if child["state"] == koji.TASK_STATES["FAILED"]:
+                failed.append((child["id"], f"{task['label']} {label}"))
+
+    with session.multicall(strict=False, batch=WATCH_BATCH) as m:
+        calls = [(task_id, label, m.getTaskResult(task_id)) for task_id, label in failed]
+
+    failures = []
+
+    for task_id, label, call in calls:
+        try:
+            call.result
+        except (koji.xmlrpcplus.Fault, koji.GenericError) as e:
+            failures.append(f"{task_id} {label}: {e.__class__.__name__}: {str(e).strip()}")
+
+    return failures
+
+
+def watch_builds(session, task_ids, quiet=False, poll_interval=5):
+    """Watch image builds until all of them have finished, polling all tasks
+    and their architecture tasks with a single multicall. The time between
+    polls doubles while nothing changes, up to `WATCH_MAX_INTERVAL`, and
+    goes back to `poll_interval` as soon as a task changes state.
+
+    Returns 1 if any of the builds didn't succeed."""
+
+    if not task_ids:
+        return 0
+
+    tasks = {
+        task_id: {"label": None, "state": None, "children": {}}
+        for task_id in task_ids
+    }
+    last = {}
+    interval = poll_interval
+    max_interval = max(poll_interval, WATCH_MAX_INTERVAL)
+
+    if not quiet:
+        print("Watching tasks (this may be safely interrupted)...")
+
+    try:
+        while True:
+            poll_builds(session, tasks)
+
+            current = {
+                task_id: (
+                    task["state"],
+                    {label: child["state"] for label, child in task["children"].items()},
+                )
+                for task_id, task in tasks.items()
+            }
+            changed = [t for t in task_ids if current[t] != last.get(t)]
+            last = current
+
+            if changed:
+                interval = poll_interval
+
+                if not quiet:
+                    print(time.strftime("%H:%M:%S"))
+                    print(format_builds(tasks, changed))
+                    sys.stdout.flush()
+            else:
+                interval = min(interval * 2, max_interval)
+
+            if all(task["state"] in DONE_STATES for task in tasks.values()):
+                break
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        if not quiet:
+            progname = os.path.basename(sys.argv[0]) or "koji"
+            running = [t for t in task_ids if tasks[t]["state"] not in DONE_STATES]
+
+            print(
+                "Tasks still running. You can continue to watch with the"
+                f" '{progname} watch-task' command.\n"
+                f"Running Tasks:\n{format_builds(tasks, running)}"
+            )
+
+        raise
+
+    if not quiet:
+        for failure in task_failures(session, tasks):
+            print(failure)
+
+    if any(task["state"] != koji.TASK_STATES["CLOSED"] for task in tasks.values()):
+        return 1
+
+    return 0
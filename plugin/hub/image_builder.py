@@ -1,6 +1,8 @@
 """Koji osbuild integration for Koji Hub"""
 
+import os
 import sys
+import hashlib
 import logging
 import jsonschema
 
@@ -29,7 +31,6 @@ IMAGE_BUILDER_BUILD_SCHEMA = {
             "type": "array",
             "description": "Image Types",
             "minItems": 1,
-            "maxItems": 1,
             "items": {"type": "string"},
         },
         {"type": "string", "description": "Name"},
@@ -107,13 +108,42 @@ IMAGE_BUILDER_BUILD_SCHEMA = {
                     "type": "array",
                     "description": "Architectures allowed to fail",
                     "items": {"type": "string"},
-                }
+                },
+                "manifest_only": {
+                    "type": "boolean",
+                    "description": "Only generate manifests, implies a scratch build",
+                },
+                "compress": {
+                    "type": "string",
+                    "enum": ["zstd", "xz"],
+                    "description": "Compress disk images and archives during upload",
+                },
             },
         },
     },
 }
 
 
+# The validator is created once, this checks the schema itself and resolves
+# its references up front instead of on every call.
+IMAGE_BUILDER_BUILD_VALIDATOR = jsonschema.validators.validator_for(
+    IMAGE_BUILDER_BUILD_SCHEMA
+)(IMAGE_BUILDER_BUILD_SCHEMA)
+IMAGE_BUILDER_BUILD_VALIDATOR.check_schema(IMAGE_BUILDER_BUILD_SCHEMA)
+
+
+def validate_build_args(args):
+    """Validate the arguments of an image build, raises `koji.ParameterError`
+    with the most relevant error when they are invalid."""
+
+    error = jsonschema.exceptions.best_match(
+        IMAGE_BUILDER_BUILD_VALIDATOR.iter_errors(args)
+    )
+
+    if error is not None:
+        raise koji.ParameterError(str(error))
+
+
 @koji.plugin.export
 def imageBuilderBuild(
     target,
@@ -135,10 +165,7 @@ def imageBuilderBuild(
 
     logger.info("creating imageBuilderBuild task")
 
-    try:
-        jsonschema.validate(args, IMAGE_BUILDER_BUILD_SCHEMA)
-    except jsonschema.exceptions.ValidationError as err:
-        raise koji.ParameterError(str(err)) from None
+    validate_build_args(args)
 
     if priority and priority < 0 and not context.session.hasPerm("admin"):
         raise koji.ActionNotAllowed(
@@ -154,3 +181,162 @@ def imageBuilderBuild(
         pass
 
     return task_id
+
+
+# The arguments of `imageBuilderBuild` that make up a build in a batch.
+BUILD_SPEC_KEYS = ("target", "arches", "types", "name", "version", "opts")
+
+
+@koji.plugin.export
+def imageBuilderBuildBatch(builds, priority=None):
+    """Create multiple images via image-builder in a single call. Each build
+    is a mapping with the arguments of `imageBuilderBuild`. Returns a task id
+    for each build in order, builds that are invalid get a fault instead and
+    don't prevent the other builds from being created."""
+    context.session.assertPerm("image")
+
+    if priority and priority < 0 and not context.session.hasPerm("admin"):
+        raise koji.ActionNotAllowed(
+            "only admins may create high-priority tasks"
+        )
+
+    task = {"channel": "image"}
+    results = []
+
+    if priority is not None:
+        task["priority"] = priority
+
+    logger.info("creating %i imageBuilderBuild tasks", len(builds))
+
+    for index, build in enumerate(builds):
+        try:
+            if not isinstance(build, dict):
+                raise koji.ParameterError(f"build {index} is not a mapping")
+
+            unknown = set(build) - set(BUILD_SPEC_KEYS)
+
+            if unknown:
+                raise koji.ParameterError(
+                    f"build {index} has unknown keys: {', '.join(sorted(unknown))}"
+                )
+
+            args = [build.get(key) for key in BUILD_SPEC_KEYS]
+
+            if args[-1] is None:
+                args[-1] = {}
+
+            validate_build_args(args)
+
+            task_id = kojihub.make_task("imageBuilderBuild", args, **task)
+
+            logger.info("imageBuilderBuild task %i created", task_id)
+
+            results.append(task_id)
+        except koji.GenericError as err:
+            results.append({"faultCode": err.faultCode, "faultString": str(err)})
+
+    return results
+
+
+def read_striped(files, blocksize):
+    """Read the blocks of `blocksize` bytes that were distributed round robin
+    over `files` in order."""
+
+    index = 0
+
+    while True:
+        chunk = files[index % len(files)].read(blocksize)
+
+        if not chunk:
+            return
+
+        yield memoryview(chunk)
+
+        index += 1
+
+
+def assemble_upload(sources, dest, blocksize, size, extents=None):
+    """Reassemble a file that was uploaded in parts over multiple streams. The
+    uploaded data was split in blocks of `blocksize` bytes which were
+    distributed round robin over the `sources`.
+
+    For sparse files only the data `extents`, a list of `(offset, length)`,
+    were uploaded. These are written at their offsets and the holes between
+    them are left unwritten so the file is recreated sparsely. Returns the
+    sha256 of the uploaded data."""
+
+    if extents is None:
+        extents = [(0, size)]
+
+    checksum = hashlib.sha256()
+    position = 0
+
+    files = [open(source, "rb") for source in sources]
+
+    try:
+        with open(dest, "wb") as out:
+            blocks = read_striped(files, blocksize)
+            pending = memoryview(b"")
+
+            for offset, length in extents:
+                if offset < position or length < 0 or offset + length > size:
+                    raise koji.GenericError(f"invalid extents for {dest}")
+
+                out.seek(offset)
+                position = offset + length
+
+                while length > 0:
+                    if not pending:
+                        pending = next(blocks, None)
+
+                        if pending is None:
+                            raise koji.GenericError(f"upload of {dest} is incomplete")
+
+                    chunk, pending = pending[:length], pending[length:]
+
+                    out.write(chunk)
+                    checksum.update(chunk)
+
+                    length -= len(chunk)
+
+            out.truncate(size)
+
+        if pending or any(f.read(1) for f in files):
+            raise koji.GenericError(f"upload of {dest} has trailing data")
+    finally:
+        for f in files:
+            f.close()
+
+    return checksum.hexdigest()
+
+
+@koji.plugin.export_in("host")
+def imageBuilderAssembleUpload(
+    task_id, name, parts, blocksize, size, sha256, extents=None
+):
+    """Reassemble a file that an imageBuilderBuildArch task uploaded in
+    multiple parts and verify the checksum of the uploaded data"""
+    host = kojihub.Host()
+    host.verify()
+
+    kojihub.Task(task_id).assertHost(host.id)
+
+    reldir = koji.pathinfo.taskrelpath(task_id)
+
+    dest = kojihub.get_upload_path(reldir, name, create=True)
+    sources = [
+        kojihub.get_upload_path(reldir, f"{name}.part{i}") for i in range(parts)
+    ]
+
+    checksum = assemble_upload(sources, dest, blocksize, size, extents)
+
+    if checksum != sha256:
+        os.unlink(dest)
+        raise koji.GenericError(
+            f"checksum mismatch for {name}: {checksum} != {sha256}"
+        )
+
+    for source in sources:
+        os.unlink(source)
+
+    logger.info("assembled %s for task %i from %i parts", name, task_id, parts)
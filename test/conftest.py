@@ -1,8 +1,18 @@
+import sys
+import types
+
 import pytest
 
 
 class MockBaseBuildTask:
-    pass
+    def getUploadDir(self):
+        return "tasks/1/1"
+
+    def uploadFile(self, filename, relPath=None, remoteName=None, volume=None):
+        if not hasattr(self, "uploads"):
+            self.uploads = []
+
+        self.uploads.append((filename, remoteName))
 
 
 class MockBuildImageTask:
@@ -11,9 +21,11 @@ class MockBuildImageTask:
 
 class MockBuildRoot:
     mock_calls = []
+    init_kwargs = {}
+    mockcfg = "koji/f42-build-1-1"
 
     def __init__(self, *args, **kwargs):
-        pass
+        MockBuildRoot.init_kwargs = kwargs
 
     def init(self):
         pass
@@ -22,7 +34,10 @@ class MockBuildRoot:
         return self._tmpdir
 
     def rootdir(self):
-        return ""
+        return self._rootdir
+
+    def resultdir(self):
+        return self._tmpdir
 
     def expire(self):
         pass
@@ -30,6 +45,13 @@ class MockBuildRoot:
     def mock(self, args):
         self.mock_calls.append(args)
 
+        # Jobs started through the parallel runner all succeed.
+        for i, arg in enumerate(args):
+            if str(arg).endswith("/parallel-run"):
+                for job in args[i + 3:]:
+                    with open(job + ".status", "w") as f:
+                        f.write("0\n")
+
         return 0
 
 
@@ -44,7 +66,20 @@ def koji_mock_kojid(mocker, tmpdir):
 
     mocker.buildroot = MockBuildRoot
     mocker.buildroot._tmpdir = tmpdir
+    mocker.buildroot._rootdir = ""
 
     mocker.buildroot.mock_calls = []
+    mocker.buildroot.init_kwargs = {}
 
     return mocker
+
+
+@pytest.fixture
+def koji_mock_kojihub(mocker):
+    """Provide the `kojihub` module that koji hub plugins import, the real one
+    is only available on a koji hub."""
+
+    kojihub = types.ModuleType("kojihub")
+    mocker.patch.dict(sys.modules, {"kojihub": kojihub})
+
+    return kojihub
@@ -1,9 +1,22 @@
+import os
+import json
+import fcntl
+import shlex
+import shutil
+import hashlib
+import subprocess
+import threading
+import configparser
+
+import koji
+import koji.util
 import pytest
 
 
 class MockOptions:
-    def __init__(self, *, topurl=None):
+    def __init__(self, *, topurl=None, topdir="/mnt/koji"):
         self.topurl = topurl
+        self.topdir = topdir
 
 
 def test_arches_for_config(koji_mock_kojid):
@@ -148,9 +161,9 @@ def test_build_arch_task_multiple_types(koji_mock_kojid):
             "--with-sbom",
             "--with-manifest",
             "--output-dir",
-            "/builddir/output",
+            "/builddir/output/minimal-raw",
             "--output-name",
-            "Fedora-Minimal-42-1.x86_64",
+            "Fedora-Minimal-42-1.x86_64.minimal-raw",
             "minimal-raw",
         ],
         [
@@ -169,9 +182,9 @@ def test_build_arch_task_multiple_types(koji_mock_kojid):
             "--with-sbom",
             "--with-manifest",
             "--output-dir",
-            "/builddir/output",
+            "/builddir/output/minimal-raw-zst",
             "--output-name",
-            "Fedora-Minimal-42-1.x86_64",
+            "Fedora-Minimal-42-1.x86_64.minimal-raw-zst",
             "minimal-raw-zst",
         ],
     ]
@@ -385,24 +398,29 @@ def test_build_arch_task_bootc(koji_mock_kojid):
         },
     )
 
+    tmpdir = koji_mock_kojid.buildroot._tmpdir
+
+    assert (tmpdir / "pull-ref.sh").read() == (
+        "exec podman pull quay.io/centos-bootc/centos-bootc:stream9 "
+        "> " + str(tmpdir) + "/pull-ref.log 2>&1\n"
+    )
+    assert (tmpdir / "pull-build-ref.sh").read() == (
+        "exec podman pull quay.io/centos-bootc/centos-bootc:stream10 "
+        "> " + str(tmpdir) + "/pull-build-ref.log 2>&1\n"
+    )
+
     assert koji_mock_kojid.buildroot.mock_calls == [
         [
             "--cwd",
-            str(koji_mock_kojid.buildroot._tmpdir),
-            "--chroot",
-            "--",
-            "podman",
-            "pull",
-            "quay.io/centos-bootc/centos-bootc:stream9",
-        ],
-        [
-            "--cwd",
-            str(koji_mock_kojid.buildroot._tmpdir),
+            str(tmpdir),
             "--chroot",
             "--",
-            "podman",
-            "pull",
-            "quay.io/centos-bootc/centos-bootc:stream10",
+            "bash",
+            str(tmpdir) + "/parallel-run",
+            "2",
+            "1",
+            str(tmpdir) + "/pull-ref.sh",
+            str(tmpdir) + "/pull-build-ref.sh",
         ],
         [
             "--cwd",
@@ -434,3 +452,1859 @@ def test_build_arch_task_bootc(koji_mock_kojid):
     ]
 
 
+def test_build_arch_task_multiple_types_single_invocation(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    root = tmpdir.mkdir("root")
+    output = root.mkdir("builddir").mkdir("output")
+    koji_mock_kojid.buildroot._rootdir = str(root)
+
+    def mock(self, args):
+        self.mock_calls.append(args)
+
+        # outputs are named after their type, the manifests of both types
+        # would share a name with an output name
+        for typ, ext in (("minimal-raw", "raw"), ("minimal-raw-zst", "raw.zst")):
+            base = output.mkdir(f"fedora-42-{typ}-x86_64")
+            base.join(f"fedora-42-{typ}-x86_64.{ext}").write(typ)
+            base.join(f"fedora-42-{typ}-x86_64.osbuild-manifest.json").write(typ)
+
+        return 0
+
+    koji_mock_kojid.patch.object(koji_mock_kojid.buildroot, "mock", mock)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = MockHubSession(str(tmpdir.mkdir("hub")))
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    data = t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw", "minimal-raw-zst"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {
+            "extra": {
+                "mock.new_chroot": 0,
+                "image_builder.single_invocation": True,
+            }
+        },
+        {"id": 1},
+        {},
+    )
+
+    assert koji_mock_kojid.buildroot.mock_calls == [
+        [
+            "--cwd",
+            str(koji_mock_kojid.buildroot._tmpdir),
+            "--chroot",
+            "--",
+            "sh",
+            str(koji_mock_kojid.buildroot._tmpdir) + "/mock-wrap",
+            "image-builder",
+            "-v",
+            "build",
+            "--use-librepo=false",
+            "--force-repo",
+            "//repos/f42-build/1/$arch",
+            "--with-sbom",
+            "--with-manifest",
+            "--output-dir",
+            "/builddir/output",
+            "minimal-raw",
+            "minimal-raw-zst",
+        ],
+    ]
+
+    assert sorted(data["files"]) == [
+        "Fedora-Minimal-42-1.x86_64.minimal-raw-zst.osbuild-manifest.json",
+        "Fedora-Minimal-42-1.x86_64.minimal-raw-zst.raw.zst",
+        "Fedora-Minimal-42-1.x86_64.minimal-raw.osbuild-manifest.json",
+        "Fedora-Minimal-42-1.x86_64.minimal-raw.raw",
+    ]
+
+    # without upload configuration the artifacts are uploaded by koji
+    uploads = {remote: local for (local, remote) in t.uploads if remote}
+
+    for typ in ("minimal-raw", "minimal-raw-zst"):
+        name = f"Fedora-Minimal-42-1.x86_64.{typ}.osbuild-manifest.json"
+        assert open(uploads[name]).read() == typ
+
+
+def test_build_arch_task_concurrent_types(koji_mock_kojid):
+    import plugin.builder.image_builder as builder
+
+    tmpdir = koji_mock_kojid.buildroot._tmpdir
+
+    def mock(self, args):
+        self.mock_calls.append(args)
+
+        # pretend the first type succeeded and the second one failed
+        (tmpdir / "build-minimal-raw.sh.status").write("0\n")
+        (tmpdir / "build-minimal-raw.log").write("")
+        (tmpdir / "build-minimal-raw-zst.sh.status").write("1\n")
+        (tmpdir / "build-minimal-raw-zst.log").write("")
+
+        return 0
+
+    koji_mock_kojid.patch.object(koji_mock_kojid.buildroot, "mock", mock)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    with pytest.raises(koji.GenericError, match="failed for: minimal-raw-zst"):
+        t.handler(
+            "Fedora-Minimal",
+            "42",
+            "1",
+            "x86_64",
+            ["minimal-raw", "minimal-raw-zst"],
+            {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+            {
+                "extra": {
+                    "mock.new_chroot": 0,
+                    "image_builder.max_concurrent_types": 2,
+                }
+            },
+            {"id": 1},
+            {},
+        )
+
+    assert koji_mock_kojid.buildroot.mock_calls == [
+        [
+            "--cwd",
+            str(tmpdir),
+            "--chroot",
+            "--",
+            "sh",
+            str(tmpdir) + "/mock-wrap",
+            "bash",
+            str(tmpdir) + "/parallel-run",
+            "2",
+            "0",
+            str(tmpdir) + "/build-minimal-raw.sh",
+            str(tmpdir) + "/build-minimal-raw-zst.sh",
+        ],
+    ]
+
+    assert (tmpdir / "build-minimal-raw-zst.sh").read() == (
+        "exec image-builder -v build --use-librepo=false "
+        "--force-repo '//repos/f42-build/1/$arch' --with-sbom --with-manifest "
+        "--output-dir /builddir/output/minimal-raw-zst "
+        "--output-name Fedora-Minimal-42-1.x86_64.minimal-raw-zst minimal-raw-zst "
+        "> " + str(tmpdir) + "/build-minimal-raw-zst.log 2>&1\n"
+    )
+
+    # the logs of both types and the profile are attached to the task
+    assert [remote for (_, remote) in t.uploads] == [None, None, None]
+    assert [local for (local, _) in t.uploads] == [
+        str(tmpdir) + "/build-minimal-raw.log",
+        str(tmpdir) + "/build-minimal-raw-zst.log",
+        str(tmpdir) + "/image-builder-profile.json",
+    ]
+
+
+def test_build_arch_task_concurrent_types_outputs(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    root = tmpdir.mkdir("root")
+    output = root.mkdir("builddir").mkdir("output")
+    koji_mock_kojid.buildroot._rootdir = str(root)
+
+    def mock(self, args):
+        # every type writes a manifest named after the output name it was
+        # given into its own output directory
+        for typ in ("minimal-raw", "minimal-raw-zst"):
+            job = tmpdir / f"build-{typ}.sh"
+            command = shlex.split(job.read())
+            name = command[command.index("--output-name") + 1]
+
+            output.mkdir(typ).join(f"{name}.osbuild-manifest.json").write(typ)
+            (tmpdir / f"build-{typ}.sh.status").write("0\n")
+
+        return 0
+
+    koji_mock_kojid.patch.object(koji_mock_kojid.buildroot, "mock", mock)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = MockHubSession(str(tmpdir.mkdir("hub")))
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    data = t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw", "minimal-raw-zst"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {
+            "extra": {
+                "mock.new_chroot": 0,
+                "image_builder.max_concurrent_types": 2,
+            }
+        },
+        {"id": 1},
+        {},
+    )
+
+    assert data["files"] == [
+        "Fedora-Minimal-42-1.x86_64.minimal-raw.osbuild-manifest.json",
+        "Fedora-Minimal-42-1.x86_64.minimal-raw-zst.osbuild-manifest.json",
+    ]
+
+    uploads = {remote: local for (local, remote) in t.uploads if remote}
+
+    for typ in ("minimal-raw", "minimal-raw-zst"):
+        name = f"Fedora-Minimal-42-1.x86_64.{typ}.osbuild-manifest.json"
+        assert open(uploads[name]).read() == typ
+
+
+def test_artifact_uploader_from_config(koji_mock_kojid):
+    import plugin.builder.image_builder as builder
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.options = MockOptions()
+    t.options.upload_blocksize = 65536
+
+    config = configparser.ConfigParser()
+
+    # without configuration koji uploads the files, compressed files are
+    # still uploaded by the plugin
+    uploader = builder.ArtifactUploader.from_config(t, config)
+
+    assert uploader.stock
+    assert uploader.blocksize == 65536
+
+    config["upload"] = {"streams": "2"}
+
+    uploader = builder.ArtifactUploader.from_config(t, config)
+
+    assert not uploader.stock
+    assert uploader.blocksize == 65536
+
+    config["upload"]["blocksize"] = "1M"
+
+    assert builder.ArtifactUploader.from_config(t, config).blocksize == 1 << 20
+
+
+def test_artifact_uploader_duplicate_name(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.session = MockHubSession(str(tmpdir.mkdir("hub")))
+
+    tmpdir.mkdir("a").join("manifest.json").write("a")
+    tmpdir.mkdir("b").join("manifest.json").write("b")
+
+    uploader = builder.ArtifactUploader(t)
+    uploader.submit(str(tmpdir.join("a", "manifest.json")), "manifest.json")
+
+    with pytest.raises(koji.GenericError, match="more than one artifact"):
+        uploader.submit(str(tmpdir.join("b", "manifest.json")), "manifest.json")
+
+    assert tmpdir.join("hub", "manifest.json").read() == "a"
+
+
+def test_parse_size(koji_mock_kojid):
+    import plugin.builder.image_builder as builder
+
+    assert builder.parse_size("512") == 512
+    assert builder.parse_size("4k") == 4096
+    assert builder.parse_size(" 10G ") == 10 * 1024**3
+
+
+def test_host_cache_slots(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    cache = builder.HostCache(str(tmpdir), 1 << 30, slots=2)
+
+    path_a, release_a = cache.acquire("f42-build-1-x86_64")
+    path_b, release_b = cache.acquire("f42-build-1-x86_64")
+
+    assert path_a == str(tmpdir / "f42-build-1-x86_64")
+    assert path_b == str(tmpdir / "f42-build-1-x86_64.1")
+
+    # all slots are in use
+    assert cache.acquire("f42-build-1-x86_64") is None
+
+    release_a()
+
+    assert cache.acquire("f42-build-1-x86_64")[0] == path_a
+
+
+def test_host_cache_prune(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    cache = builder.HostCache(str(tmpdir), 12 * 1024)
+
+    for age, key in enumerate(["new", "old", "older"]):
+        path = tmpdir.mkdir(key)
+        path.join("data").write_binary(os.urandom(8 * 1024))
+        os.utime(path, (1000 - age, 1000 - age))
+        tmpdir.join(f"{key}.lock").write("")
+
+    path, release = cache.acquire("locked")
+    os.utime(path, (0, 0))
+
+    cache.prune()
+
+    # the least recently used entries are gone together with their lock
+    # files, locked entries are kept
+    assert sorted(p.basename for p in tmpdir.listdir() if p.isdir()) == [
+        "locked",
+        "new",
+    ]
+    assert sorted(p.basename for p in tmpdir.listdir() if p.isfile()) == [
+        "locked.lock",
+        "new.lock",
+    ]
+
+    release()
+
+
+def test_host_cache_lock_removed(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    cache = builder.HostCache(str(tmpdir), 1 << 30)
+    flock = fcntl.flock
+    calls = []
+
+    def remove_then_flock(fd, mode):
+        # the entry and its lock file are removed by another task between
+        # opening and locking the lock file
+        if not calls:
+            os.unlink(str(tmpdir.join("key.lock")))
+
+        calls.append(fd)
+
+        return flock(fd, mode)
+
+    koji_mock_kojid.patch.object(builder.fcntl, "flock", remove_then_flock)
+
+    fd = cache._lock("key", fcntl.LOCK_EX)
+
+    # the lock is taken again on the lock file that exists now
+    assert len(calls) == 2
+    assert os.fstat(fd).st_ino == os.stat(str(tmpdir.join("key.lock"))).st_ino
+
+    os.close(fd)
+
+
+def test_build_arch_task_store_cache(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["store_cache"] = {"path": str(tmpdir / "store"), "max_size": "1G"}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {},
+    )
+
+    assert koji_mock_kojid.buildroot.init_kwargs["bind_opts"] == {
+        "dirs": {
+            "/dev": "/dev",
+            str(tmpdir / "store" / "f42-build-1-x86_64"): "/builddir/cache/store",
+        },
+    }
+
+    assert koji_mock_kojid.buildroot.mock_calls[0][9:13] == [
+        "--use-librepo=false",
+        "--cache",
+        "/builddir/cache/store",
+        "--force-repo",
+    ]
+
+
+def test_build_arch_task_depsolve_cache(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["depsolve_cache"] = {"path": str(tmpdir / "depsolve")}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {"repos": ["a/$arch/b"]},
+    )
+
+    (entry,) = tmpdir.join("depsolve").listdir(lambda p: p.isdir())
+
+    # custom repositories are keyed by their (resolved) urls
+    assert entry.basename.startswith("repos-")
+    assert entry.basename.endswith("-x86_64")
+
+    assert koji_mock_kojid.buildroot.init_kwargs["bind_opts"]["dirs"] == {
+        "/dev": "/dev",
+        str(entry): "/builddir/cache/depsolve",
+    }
+
+    assert koji_mock_kojid.buildroot.mock_calls[0][6:12] == [
+        "env",
+        "XDG_CACHE_HOME=/builddir/cache/depsolve",
+        "image-builder",
+        "-v",
+        "build",
+        "--use-librepo=false",
+    ]
+
+
+def test_host_cache_prune_max_age(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    cache = builder.HostCache(str(tmpdir), 1 << 30, max_age=60)
+
+    tmpdir.mkdir("fresh")
+    os.utime(tmpdir.mkdir("stale"), (0, 0))
+
+    cache.prune()
+
+    assert [p.basename for p in tmpdir.listdir()] == ["fresh"]
+
+
+def test_build_arch_task_bootc_container_cache(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["container_cache"] = {"path": str(tmpdir / "containers")}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    t.handler(
+        "Fedora-bootc",
+        "42",
+        "1",
+        "x86_64",
+        ["qcow2"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {
+            "bootc": {
+                "ref": "quay.io/centos-bootc/centos-bootc:stream9",
+            },
+        },
+    )
+
+    assert koji_mock_kojid.buildroot.init_kwargs["bind_opts"]["dirs"] == {
+        "/dev": "/dev",
+        str(tmpdir / "containers" / "storage"): "/var/lib/containers/storage",
+    }
+
+    calls = koji_mock_kojid.buildroot.mock_calls
+
+    assert (koji_mock_kojid.buildroot._tmpdir / "pull-ref.sh").read().startswith(
+        "exec podman pull --policy=newer quay.io/centos-bootc/centos-bootc:stream9 "
+    )
+    assert calls[-1][4:] == ["podman", "image", "prune", "--force"]
+
+
+def test_build_arch_task_bootc_pull_size(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["container_cache"] = {"path": str(tmpdir / "containers")}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    layers = tmpdir.join("containers", "storage", "overlay-layers", "layers.json")
+    layers.write(json.dumps([{"id": "a", "compressed-size": 100}]), ensure=True)
+
+    mock = koji_mock_kojid.buildroot.mock
+
+    def pull(self, args):
+        # the pull adds a layer to the ones that were there already
+        if any(str(arg).endswith("/parallel-run") for arg in args):
+            layers.write(
+                json.dumps(
+                    [
+                        {"id": "a", "compressed-size": 100},
+                        {"id": "b", "compressed-size": 42, "diff-size": 84},
+                    ]
+                )
+            )
+
+        return mock(self, args)
+
+    koji_mock_kojid.patch.object(koji_mock_kojid.buildroot, "mock", pull)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    t.handler(
+        "Fedora-bootc",
+        "42",
+        "1",
+        "x86_64",
+        ["qcow2"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {"bootc": {"ref": "quay.io/centos-bootc/centos-bootc:stream9"}},
+    )
+
+    [phase] = [p for p in t.profile.phases if p["name"] == "container-pulls"]
+
+    assert phase["size"] == 42
+
+
+def test_build_arch_task_bootc_pull_fails(koji_mock_kojid):
+    import plugin.builder.image_builder as builder
+
+    tmpdir = koji_mock_kojid.buildroot._tmpdir
+
+    def mock(self, args):
+        self.mock_calls.append(args)
+
+        # the build container failed to pull, the main container was cancelled
+        (tmpdir / "pull-build-ref.sh.status").write("125\n")
+
+        return 1
+
+    koji_mock_kojid.patch.object(koji_mock_kojid.buildroot, "mock", mock)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    with pytest.raises(
+        koji.GenericError,
+        match="failed to pull container build-ref: quay.io/centos-bootc/centos-bootc:stream10",
+    ):
+        t.handler(
+            "Fedora-bootc",
+            "42",
+            "1",
+            "x86_64",
+            ["qcow2"],
+            {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+            {"extra": {"mock.new_chroot": 0}},
+            {"id": 1},
+            {
+                "bootc": {
+                    "ref": "quay.io/centos-bootc/centos-bootc:stream9",
+                    "build-ref": "quay.io/centos-bootc/centos-bootc:stream10",
+                },
+            },
+        )
+
+    # no build is attempted
+    assert len(koji_mock_kojid.buildroot.mock_calls) == 1
+
+
+class MockHubSession:
+    """A stand-in for a session with the hub that writes uploads into a
+    directory and hands reassembly to the hub plugin."""
+
+    def __init__(self, path, hub=None):
+        self.path = path
+        self.hub = hub
+        self.host = self
+        self.logged_out = False
+        self.subsessions = []
+        self.uploaded = threading.Event()
+
+    def subsession(self):
+        session = MockHubSession(self.path, self.hub)
+        session.uploaded = self.uploaded
+        self.subsessions.append(session)
+
+        return session
+
+    def logout(self):
+        self.logged_out = True
+
+    def rawUpload(self, chunk, offset, path, name, overwrite=False):
+        target = os.path.join(self.path, name)
+
+        with open(target, "r+b" if os.path.exists(target) else "wb") as f:
+            f.seek(offset)
+            f.write(chunk)
+
+        return {
+            "size": len(chunk),
+            "hexdigest": koji.util.adler32_constructor(chunk).hexdigest(),
+        }
+
+    def checkUpload(self, path, name):
+        self.uploaded.set()
+
+        return {"size": os.path.getsize(os.path.join(self.path, name))}
+
+    def imageBuilderAssembleUpload(self, *args):
+        return self.hub.imageBuilderAssembleUpload(*args)
+
+
+def test_build_arch_task_pipelined_upload(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["upload"] = {"pipelined": "true"}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    root = tmpdir.mkdir("root")
+    output = root.mkdir("builddir").mkdir("output")
+    koji_mock_kojid.buildroot._rootdir = str(root)
+
+    session = MockHubSession(str(tmpdir.mkdir("hub")))
+
+    def mock(self, args):
+        typ = args[-1]
+        path = root.join(args[args.index("--output-dir") + 1])
+        name = args[args.index("--output-name") + 1]
+
+        if typ == "minimal-raw-zst":
+            # the artifacts of the first type are uploaded while this type
+            # is being built
+            assert session.uploaded.wait(timeout=10)
+
+        koji.ensuredir(str(path))
+
+        path.join(f"{name}.img").write(typ)
+        path.join(f"{name}.osbuild-manifest.json").write(typ)
+
+        return 0
+
+    koji_mock_kojid.patch.object(koji_mock_kojid.buildroot, "mock", mock)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = session
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    data = t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw", "minimal-raw-zst"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {},
+    )
+
+    prefix = "Fedora-Minimal-42-1.x86_64"
+
+    assert data["files"] == [
+        f"{prefix}.minimal-raw.img",
+        f"{prefix}.minimal-raw.osbuild-manifest.json",
+        f"{prefix}.minimal-raw-zst.img",
+        f"{prefix}.minimal-raw-zst.osbuild-manifest.json",
+    ]
+    assert data["file_info"][f"{prefix}.minimal-raw.img"] == {
+        "checksum_type": "sha256",
+        "checksum": hashlib.sha256(b"minimal-raw").hexdigest(),
+        "filesize": 11,
+    }
+    assert data["file_info"][f"{prefix}.minimal-raw-zst.img"] == {
+        "checksum_type": "sha256",
+        "checksum": hashlib.sha256(b"minimal-raw-zst").hexdigest(),
+        "filesize": 15,
+    }
+
+    hub = tmpdir.join("hub")
+
+    # the outputs the types have in common are not written again by the
+    # type that is built later, each type's copy is uploaded
+    for typ in ("minimal-raw", "minimal-raw-zst"):
+        assert hub.join(f"{prefix}.{typ}.img").read() == typ
+        assert hub.join(f"{prefix}.{typ}.osbuild-manifest.json").read() == typ
+        assert output.join(typ, f"{prefix}.{typ}.osbuild-manifest.json").read() == typ
+
+    assert session.subsessions[0].logged_out
+
+
+@pytest.fixture
+def mock_hub(koji_mock_kojihub, tmpdir):
+    import plugin.hub.image_builder as hub
+
+    path = tmpdir.mkdir("hub")
+
+    class Host:
+        id = 1
+
+        def verify(self):
+            pass
+
+    class Task:
+        def __init__(self, task_id):
+            pass
+
+        def assertHost(self, host_id):
+            assert host_id == 1
+
+    koji_mock_kojihub.Host = Host
+    koji_mock_kojihub.Task = Task
+    koji_mock_kojihub.get_upload_path = (
+        lambda reldir, name, create=False: str(path.join(name))
+    )
+
+    return MockHubSession(str(path), hub)
+
+
+def test_artifact_uploader_striped(koji_mock_kojid, mock_hub, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    data = os.urandom(10 * 4096 + 123)
+    tmpdir.join("disk.raw").write_binary(data)
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.id = 1
+    t.session = mock_hub
+
+    uploader = builder.ArtifactUploader(t, streams=3, blocksize=4096, min_size=1)
+    uploader.submit(str(tmpdir.join("disk.raw")), "disk.raw")
+    uploader.wait()
+    uploader.close()
+
+    assert uploader.file_info["disk.raw"] == {
+        "checksum_type": "sha256",
+        "checksum": hashlib.sha256(data).hexdigest(),
+        "filesize": len(data),
+    }
+
+    hub = tmpdir.join("hub")
+
+    # the hub only has the reassembled file, the parts are removed
+    assert [p.basename for p in hub.listdir()] == ["disk.raw"]
+    assert hub.join("disk.raw").read_binary() == data
+
+    assert len(mock_hub.subsessions) == 3
+    assert all(s.logged_out for s in mock_hub.subsessions)
+
+
+def test_artifact_uploader_striped_pipelined(koji_mock_kojid, mock_hub, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    data = os.urandom(10 * 4096 + 123)
+    tmpdir.join("disk.raw").write_binary(data)
+
+    threads = []
+    subsession = mock_hub.subsession
+
+    def record():
+        threads.append(threading.current_thread())
+        return subsession()
+
+    mock_hub.subsession = record
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.id = 1
+    t.session = mock_hub
+
+    tmpdir.join("small.json").write("{}")
+
+    uploader = builder.ArtifactUploader(
+        t, pipelined=True, streams=3, blocksize=4096, min_size=1024
+    )
+
+    # the stream sessions are only created for a file that is striped
+    uploader.submit(str(tmpdir.join("small.json")), "small.json")
+    assert len(threads) == 1
+
+    uploader.submit(str(tmpdir.join("disk.raw")), "disk.raw")
+    uploader.wait()
+    uploader.close()
+
+    assert tmpdir.join("hub", "disk.raw").read_binary() == data
+
+    # the sessions of the background upload and its streams are all created
+    # by the thread that owns the task's session
+    assert threads == [threading.main_thread()] * 4
+
+
+def test_artifact_uploader_striped_checksum_mismatch(
+    koji_mock_kojid, mock_hub, tmpdir
+):
+    import plugin.builder.image_builder as builder
+
+    tmpdir.join("disk.raw").write_binary(os.urandom(4 * 4096))
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.id = 1
+    t.session = mock_hub
+
+    # corrupt every chunk on its way to the hub
+    raw_upload = MockHubSession.rawUpload
+
+    def corrupt(self, chunk, *args, **kwargs):
+        result = raw_upload(self, b"x" * len(chunk), *args, **kwargs)
+        result["hexdigest"] = koji.util.adler32_constructor(chunk).hexdigest()
+        return result
+
+    koji_mock_kojid.patch.object(MockHubSession, "rawUpload", corrupt)
+
+    uploader = builder.ArtifactUploader(t, streams=2, blocksize=4096, min_size=1)
+
+    with pytest.raises(koji.GenericError, match="checksum mismatch"):
+        uploader.submit(str(tmpdir.join("disk.raw")), "disk.raw")
+
+    uploader.close()
+
+
+def test_artifact_uploader_empty_file(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    tmpdir.join("empty.json").write("")
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.id = 1
+    t.session = MockHubSession(str(tmpdir.mkdir("hub")))
+
+    uploader = builder.ArtifactUploader(t)
+    uploader.submit(str(tmpdir.join("empty.json")), "empty.json")
+
+    assert tmpdir.join("hub", "empty.json").read() == ""
+    assert uploader.file_info["empty.json"]["filesize"] == 0
+
+
+def test_data_extents(tmpdir):
+    import plugin.builder.image_builder as builder
+
+    path = str(tmpdir.join("disk.raw"))
+
+    with open(path, "wb") as f:
+        f.truncate(16 << 20)
+        f.seek(1 << 20)
+        f.write(b"a" * 5000)
+
+    extents = builder.data_extents(path)
+
+    # filesystems round extents to their block size
+    assert len(extents) == 1
+    assert extents[0][0] <= 1 << 20
+    assert extents[0][0] + extents[0][1] >= (1 << 20) + 5000
+
+    tmpdir.join("empty").write("")
+    assert builder.data_extents(str(tmpdir.join("empty"))) == []
+
+
+@pytest.mark.parametrize("holes_only", [False, True])
+def test_artifact_uploader_sparse(koji_mock_kojid, mock_hub, tmpdir, holes_only):
+    import plugin.builder.image_builder as builder
+
+    size = 32 << 20
+    data = bytearray(size)
+
+    if not holes_only:
+        data[1 << 20:(1 << 20) + 5000] = os.urandom(5000)
+        data[20 << 20:(21 << 20) + 17] = os.urandom((1 << 20) + 17)
+
+    path = str(tmpdir.join("disk.raw"))
+
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+        if not holes_only:
+            f.seek(1 << 20)
+            f.write(data[1 << 20:(1 << 20) + 5000])
+            f.seek(20 << 20)
+            f.write(data[20 << 20:(21 << 20) + 17])
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.id = 1
+    t.session = mock_hub
+
+    uploaded = []
+    raw_upload = MockHubSession.rawUpload
+
+    def record(self, chunk, *args, **kwargs):
+        uploaded.append(len(chunk))
+        return raw_upload(self, chunk, *args, **kwargs)
+
+    koji_mock_kojid.patch.object(MockHubSession, "rawUpload", record)
+
+    uploader = builder.ArtifactUploader(
+        t, streams=2, blocksize=1 << 20, min_size=1 << 40, sparse=True
+    )
+    uploader.submit(path, "disk.raw")
+    uploader.close()
+
+    assert uploader.file_info["disk.raw"] == {
+        "checksum_type": "sha256",
+        "checksum": hashlib.sha256(data).hexdigest(),
+        "filesize": size,
+    }
+
+    hub = tmpdir.join("hub")
+
+    assert [p.basename for p in hub.listdir()] == ["disk.raw"]
+    assert hub.join("disk.raw").read_binary() == data
+
+    # only the data extents were uploaded
+    assert sum(uploaded) < 4 << 20
+
+
+@pytest.mark.parametrize("streams", [1, 3])
+@pytest.mark.parametrize("compress,suffix", [("zstd", "zst"), ("xz", "xz")])
+def test_artifact_uploader_compress(
+    koji_mock_kojid, mock_hub, tmpdir, compress, suffix, streams
+):
+    import plugin.builder.image_builder as builder
+
+    if shutil.which(builder.COMPRESSORS[compress][1][0]) is None:
+        pytest.skip(f"{compress} is not available")
+
+    data = os.urandom(1 << 16) * 64
+    tmpdir.join("disk.raw").write_binary(data)
+    tmpdir.join("disk.qcow2").write_binary(data)
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.id = 1
+    t.session = mock_hub
+
+    uploader = builder.ArtifactUploader(
+        t, streams=streams, blocksize=1 << 16, min_size=1, compress=compress
+    )
+    uploader.submit(str(tmpdir.join("disk.raw")), "disk.raw")
+    uploader.submit(str(tmpdir.join("disk.qcow2")), "disk.qcow2")
+    uploader.close()
+
+    name = f"disk.raw.{suffix}"
+
+    assert uploader.files == [name, "disk.qcow2"]
+
+    compressed = tmpdir.join("hub", name).read_binary()
+
+    assert len(compressed) < len(data)
+    assert uploader.file_info[name] == {
+        "checksum_type": "sha256",
+        "checksum": hashlib.sha256(compressed).hexdigest(),
+        "filesize": len(compressed),
+        "compression": compress,
+    }
+
+    decompressed = subprocess.run(
+        [builder.COMPRESSORS[compress][1][0], "-d", "-c"],
+        input=compressed,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+    assert decompressed == data
+
+    # formats that aren't compressible are uploaded as they are
+    assert tmpdir.join("hub", "disk.qcow2").read_binary() == data
+
+
+def test_artifact_uploader_compress_unsupported(koji_mock_kojid):
+    import plugin.builder.image_builder as builder
+
+    with pytest.raises(koji.GenericError, match="unsupported compression"):
+        builder.ArtifactUploader(builder.ImageBuilderBuildArchTask(), compress="gzip")
+
+
+def test_build_arch_task_buildroot_cache(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["buildroot_cache"] = {"path": str(tmpdir / "buildroot")}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+    koji_mock_kojid.patch.object(builder, "MOCK_CONFIG_DIR", str(tmpdir / "mock"))
+
+    mock_config = tmpdir.mkdir("mock").mkdir("koji").join("f42-build-1-1.cfg")
+    mock_config.write("config_opts['plugin_conf']['root_cache_enable'] = False\n")
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {},
+    )
+
+    entry = str(tmpdir / "buildroot" / "f42-build-1-x86_64")
+
+    config_opts = {"plugin_conf": {"root_cache_opts": {}}}
+    exec(mock_config.read(), {"config_opts": config_opts})
+
+    assert config_opts["plugin_conf"] == {
+        "root_cache_enable": True,
+        "root_cache_opts": {"dir": entry, "age_check": False},
+    }
+
+
+def test_shared_host_cache(tmpdir):
+    import plugin.builder.image_builder as builder
+
+    cache = builder.SharedHostCache(str(tmpdir), 3 * 4096)
+
+    path, release = cache.acquire("rpms")
+    other_path, other_release = cache.acquire("rpms")
+
+    assert path == other_path
+
+    for i in range(5):
+        name = os.path.join(path, f"sha256:{i}")
+
+        with open(name, "wb") as f:
+            f.write(b"a" * 4096)
+
+        os.utime(name, (1000 + i, 1000 + i))
+
+    # the cache is still in use by another task, nothing is removed
+    release()
+    assert len(os.listdir(path)) == 5
+
+    # the last task to release the cache removes the least recently used
+    other_release()
+    assert sorted(os.listdir(path)) == ["sha256:2", "sha256:3", "sha256:4"]
+
+    # the cache can't be used while it's being pruned
+    fd = cache._lock("rpms", builder.fcntl.LOCK_EX)
+    assert cache.acquire("rpms") is None
+    os.close(fd)
+
+
+def test_build_arch_task_rpm_cache(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["store_cache"] = {"path": str(tmpdir / "store")}
+    config["rpm_cache"] = {"path": str(tmpdir / "rpms")}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {},
+    )
+
+    # the shared cache is mounted over the sources of the store
+    assert list(koji_mock_kojid.buildroot.init_kwargs["bind_opts"]["dirs"].items()) == [
+        ("/dev", "/dev"),
+        (str(tmpdir / "store" / "f42-build-1-x86_64"), "/builddir/cache/store"),
+        (
+            str(tmpdir / "rpms" / "rpms"),
+            "/builddir/cache/store/sources/org.osbuild.files",
+        ),
+    ]
+
+
+def test_build_arch_task_rpm_cache_without_store(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["rpm_cache"] = {"path": str(tmpdir / "rpms")}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {},
+    )
+
+    # the store is kept within the build root but still uses the shared cache
+    # for its sources
+    assert koji_mock_kojid.buildroot.mock_calls[0][9:13] == [
+        "--use-librepo=false",
+        "--cache",
+        "/builddir/cache/store",
+        "--force-repo",
+    ]
+
+
+@pytest.mark.parametrize("available", [True, False])
+def test_build_arch_task_local_topdir(koji_mock_kojid, tmpdir, available):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["repos"] = {"local_topdir": "true"}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+    koji_mock_kojid.patch.object(builder, "MOCK_CONFIG_DIR", str(tmpdir / "mock"))
+
+    mock_config = tmpdir.mkdir("mock").mkdir("koji").join("f42-build-1-1.cfg")
+    mock_config.write("")
+
+    topdir = tmpdir.mkdir("koji")
+    topdir.mkdir("packages")
+    topdir.mkdir("vol").mkdir("archive").mkdir("packages")
+
+    if available:
+        topdir.mkdir("repos").mkdir("f42-build").mkdir("1").mkdir("x86_64")
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="https://koji", topdir=str(topdir))
+    t.workdir = None
+
+    t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {},
+    )
+
+    args = koji_mock_kojid.buildroot.mock_calls[0]
+    repo = args[args.index("--force-repo") + 1]
+    dirs = koji_mock_kojid.buildroot.init_kwargs["bind_opts"]["dirs"]
+
+    # the topdir is never mounted as a whole, or writable
+    assert str(topdir) not in dirs
+
+    if available:
+        assert repo == f"file://{topdir}/repos/f42-build/1/$arch"
+
+        # only the repository and the packages are mounted, read-only
+        mounts = [
+            f"{topdir}/repos/f42-build/1",
+            f"{topdir}/packages",
+            f"{topdir}/vol/archive/packages",
+        ]
+
+        assert mock_config.read() == "".join(
+            ["config_opts['plugin_conf']['mount_enable'] = True\n"]
+            + [
+                "config_opts['plugin_conf']['mount_opts']['dirs'].append("
+                f"({path!r}, {path!r}, 'none', 'bind,ro'))\n"
+                for path in mounts
+            ]
+        )
+    else:
+        # the repository isn't available locally, use the web frontend
+        assert repo == "https://koji/repos/f42-build/1/$arch"
+        assert mock_config.read() == ""
+
+
+def test_build_arch_task_artifact_cache(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["artifact_cache"] = {"path": str(tmpdir / "artifacts")}
+    config["upload"] = {}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    root = tmpdir.mkdir("root")
+    output = root.mkdir("builddir").mkdir("output")
+    koji_mock_kojid.buildroot._rootdir = str(root)
+
+    def mock(self, args):
+        self.mock_calls.append(args)
+        output.join(f"{args[args.index('--output-name') + 1]}.raw").write("image")
+
+        return 0
+
+    koji_mock_kojid.patch.object(koji_mock_kojid.buildroot, "mock", mock)
+
+    def build(task_id, release, opts):
+        t = builder.ImageBuilderBuildArchTask()
+
+        t.id = task_id
+        t.session = MockHubSession(str(tmpdir.ensure(f"hub{task_id}", dir=True)))
+        t.options = MockOptions(topurl="/")
+        t.workdir = None
+
+        return t.handler(
+            "Fedora-Minimal",
+            "42",
+            release,
+            "x86_64",
+            ["minimal-raw"],
+            {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+            {"extra": {"mock.new_chroot": 0}},
+            {"id": 1},
+            opts,
+        )
+
+    data = build(1, "1", {"seed": 42})
+
+    assert "reused" not in data
+    assert len(koji_mock_kojid.buildroot.mock_calls) == 1
+
+    # a respin with the same inputs reuses the artifacts of the first build
+    output.remove()
+
+    data = build(2, "2", {"seed": 42})
+
+    assert len(koji_mock_kojid.buildroot.mock_calls) == 1
+    assert data["files"] == ["Fedora-Minimal-42-2.x86_64.raw"]
+    assert data["reused"]["task_id"] == 1
+    assert tmpdir.join("hub2", "Fedora-Minimal-42-2.x86_64.raw").read() == "image"
+
+    # different inputs are built
+    output.ensure(dir=True)
+
+    data = build(3, "3", {"seed": 43})
+
+    assert "reused" not in data
+    assert len(koji_mock_kojid.buildroot.mock_calls) == 2
+
+
+def test_build_arch_task_input_digest(koji_mock_kojid):
+    import plugin.builder.image_builder as builder
+
+    def digest(opts):
+        t = builder.ImageBuilderBuildArchTask()
+        t.opts = opts
+
+        return t.input_digest(
+            ["minimal-raw"], "x86_64", {"build_tag": 1}, {"id": 1}
+        )
+
+    assert digest({}) is None
+    assert digest({"seed": 1, "repos": ["https://example.com"]}) is None
+    assert digest({"seed": 1, "ostree": {"ref": "a"}}) is None
+    assert digest({"seed": 1, "bootc": {"ref": "quay.io/a:latest"}}) is None
+
+    assert digest({"seed": 1}) != digest({"seed": 2})
+    assert digest({"seed": 1, "bootc": {"ref": "quay.io/a@sha256:00"}}) is not None
+
+
+def test_build_arch_task_manifest_only(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    koji_mock_kojid.buildroot._rootdir = str(tmpdir.mkdir("root"))
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw", "minimal-raw-zst"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {"manifest_only": True, "seed": 42},
+    )
+
+    # all manifests are generated at once
+    assert koji_mock_kojid.buildroot.mock_calls[0][6:] == [
+        "bash",
+        str(tmpdir) + "/parallel-run",
+        "2",
+        "0",
+        str(tmpdir) + "/manifest-minimal-raw.sh",
+        str(tmpdir) + "/manifest-minimal-raw-zst.sh",
+    ]
+
+    assert (tmpdir / "manifest-minimal-raw.sh").read() == (
+        "exec sh -c 'image-builder -v manifest --use-librepo=false "
+        "--force-repo '\"'\"'//repos/f42-build/1/$arch'\"'\"' --seed 42 minimal-raw "
+        "> /builddir/output/Fedora-Minimal-42-1.x86_64.minimal-raw.manifest.json' "
+        "> " + str(tmpdir) + "/manifest-minimal-raw.log 2>&1\n"
+    )
+
+
+def test_build_arch_task_manifest_only_caches(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+
+    for section in ("store_cache", "rpm_cache", "depsolve_cache", "buildroot_cache"):
+        config[section] = {"path": str(tmpdir / section)}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    koji_mock_kojid.buildroot._rootdir = str(tmpdir.mkdir("root"))
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {"manifest_only": True},
+    )
+
+    # only the depsolve cache is used, the others are left to builds
+    assert koji_mock_kojid.buildroot.init_kwargs["bind_opts"]["dirs"] == {
+        "/dev": "/dev",
+        str(tmpdir / "depsolve_cache" / "f42-build-1-x86_64"): (
+            builder.ImageBuilderBuildArchTask.DEPSOLVE_CACHE_DIR
+        ),
+    }
+
+    assert not os.path.exists(tmpdir / "store_cache")
+    assert not os.path.exists(tmpdir / "rpm_cache")
+    assert not os.path.exists(tmpdir / "buildroot_cache")
+
+
+class MockMultiCall:
+    """A stand-in for a koji multicall, calls are done right away."""
+
+    class Call:
+        def __init__(self, result):
+            self.result = result
+
+    def __init__(self, session):
+        self.session = session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __getattr__(self, name):
+        if name == "host":
+            return MockMultiCall(self.session.host)
+
+        method = getattr(self.session, name)
+
+        return lambda *args, **kwargs: self.Call(method(*args, **kwargs))
+
+
+class MockParentSession:
+    def __init__(self, states):
+        self.host = self
+        self.states = states
+        self.subtasks = {}
+        self.releases = 0
+        self.multicalls = 0
+
+    def multicall(self, strict=False):
+        self.multicalls += 1
+        return MockMultiCall(self)
+
+    def getBuildTarget(self, target, strict=False):
+        return {"build_tag": 1, "build_tag_name": "f42-build", "dest_tag": 2}
+
+    def getBuildConfig(self, tag):
+        return {"arches": "x86_64 aarch64 s390x", "extra": {}}
+
+    def getNextRelease(self, build_info):
+        self.releases += 1
+        return "1"
+
+    def getTaskInfo(self, task_id):
+        return {
+            "id": task_id,
+            "state": koji.TASK_STATES[self.states[task_id]],
+            "weight": 2.5,
+        }
+
+    def subtask(self, method, arglist, label, parent, arch):
+        self.subtasks[arch] = 100 + len(self.subtasks)
+        return self.subtasks[arch]
+
+    def moveImageBuildToScratch(self, task_id, results):
+        pass
+
+
+def test_build_task_cancels_subtasks(koji_mock_kojid):
+    import plugin.builder.image_builder as builder
+
+    t = builder.ImageBuilderBuildTask()
+
+    t.id = 1
+    t.session = MockParentSession(
+        {100: "FAILED", 101: "CANCELED", 102: "CANCELED"}
+    )
+    t.getRepo = lambda tag: {"id": 1}
+
+    def wait(subtasks, all=False, failany=False, canfail=None):
+        assert failany
+
+        raise koji.BuildError("x86_64 failed")
+
+    t.wait = wait
+
+    with pytest.raises(koji.BuildError) as e:
+        t.handler(
+            "f42",
+            ["x86_64", "aarch64", "s390x"],
+            ["minimal-raw"],
+            "Fedora-Minimal",
+            "42",
+            {"scratch": True},
+        )
+
+    assert str(e.value) == (
+        "x86_64 failed (cancelled aarch64 (101), s390x (102), "
+        "freeing a weight of 5.00)"
+    )
+
+
+def test_build_task_batches_calls(koji_mock_kojid):
+    import plugin.builder.image_builder as builder
+
+    t = builder.ImageBuilderBuildTask()
+
+    t.id = 1
+    t.session = MockParentSession({})
+    t.getRepo = lambda tag: {"id": 1}
+
+    def wait(subtasks, all=False, failany=False, canfail=None):
+        assert subtasks == [100, 101, 102]
+        assert canfail == [102]
+
+        return {task_id: {"files": []} for task_id in subtasks}
+
+    t.wait = wait
+
+    t.handler(
+        "f42",
+        ["x86_64", "aarch64", "s390x"],
+        ["minimal-raw"],
+        "Fedora-Minimal",
+        "42",
+        {"scratch": True, "failable_arches": ["s390x"]},
+    )
+
+    # one multicall for the target and release, one for the subtasks
+    assert t.session.multicalls == 2
+    assert t.session.releases == 1
+    assert t.session.subtasks == {"x86_64": 100, "aarch64": 101, "s390x": 102}
+
+    t.session = MockParentSession({})
+
+    t.handler(
+        "f42",
+        ["x86_64", "aarch64", "s390x"],
+        ["minimal-raw"],
+        "Fedora-Minimal",
+        "42",
+        {"scratch": True, "failable_arches": ["s390x"], "release": "2"},
+    )
+
+    assert t.session.releases == 0
+
+
+OSBUILD_OUTPUT = """\
+starting osbuild
+Pipeline build: {a}
+Build
+  root: <host>
+org.osbuild.rpm: {b} {{
+  "gpgkeys": []
+}}
+\x1b[1m⏱  Duration: 12s\x1b[0m
+org.osbuild.selinux: {c} {{
+}}
+⏱  Duration: 1s
+Pipeline os: {d}
+org.osbuild.rpm: {e} {{
+}}
+⏱  Duration: 30.5s
+""".format(a="a" * 64, b="b" * 64, c="c" * 64, d="d" * 64, e="e" * 64)
+
+
+def test_profile_parse_log(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    tmpdir.join("build.log").write(OSBUILD_OUTPUT)
+
+    profile = builder.Profile()
+    profile.parse_log(str(tmpdir.join("build.log")))
+    profile.parse_log(str(tmpdir.join("missing.log")))
+
+    assert [
+        (stage["log"], stage["pipeline"], stage["stage"], stage["duration"])
+        for stage in profile.stages
+    ] == [
+        ("build.log", "build", "org.osbuild.rpm", 12.0),
+        ("build.log", "build", "org.osbuild.selinux", 1.0),
+        ("build.log", "os", "org.osbuild.rpm", 30.5),
+    ]
+
+    with pytest.raises(RuntimeError):
+        with profile.phase("build"):
+            raise RuntimeError()
+
+    profile.add("upload-a.raw", profile.start, 2, size=10)
+    profile.add("upload-b.raw", profile.start, 3, size=10)
+
+    summary = profile.summary()
+
+    assert summary["phases"] == {"build": summary["phases"]["build"]}
+    assert summary["upload"] == 5
+    assert summary["stages"] == {"org.osbuild.rpm": 42.5, "org.osbuild.selinux": 1.0}
+
+    assert profile.phases[0]["failed"]
+
+
+def test_build_arch_task_profile(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    tmpdir.join("mock_output.log").write(OSBUILD_OUTPUT)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    data = t.handler(
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw", "minimal-raw-zst"],
+        {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+        {"extra": {"mock.new_chroot": 0}},
+        {"id": 1},
+        {},
+    )
+
+    assert data["logs"] == ["image-builder-profile.json"]
+    assert list(data["profile"]["phases"]) == [
+        "buildroot-init",
+        "wrapper-setup",
+        "build-minimal-raw",
+        "build-minimal-raw-zst",
+        "finish-uploads",
+    ]
+    assert data["profile"]["stages"]["org.osbuild.rpm"] == 42.5
+
+    with open(tmpdir.join("image-builder-profile.json")) as f:
+        profile = json.load(f)
+
+    assert [stage["pipeline"] for stage in profile["stages"]] == [
+        "build",
+        "build",
+        "os",
+    ]
+
+
+def test_metrics(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    path = str(tmpdir.join("metrics", "koji_image_builder.prom"))
+
+    for duration in (30, 900):
+        metrics = builder.Metrics(path)
+        metrics.inc(
+            "koji_image_builder_tasks_total", {"arch": "x86_64", "result": "success"}
+        )
+        metrics.observe(
+            "koji_image_builder_build_duration_seconds",
+            {"arch": "x86_64", "type": "minimal-raw"},
+            duration,
+        )
+        metrics.write()
+
+    text = tmpdir.join("metrics", "koji_image_builder.prom").read()
+
+    assert (
+        'koji_image_builder_tasks_total{arch="x86_64",result="success"} 2\n' in text
+    )
+
+    name = "koji_image_builder_build_duration_seconds"
+    labels = 'arch="x86_64",type="minimal-raw"'
+
+    assert f'{name}_bucket{{{labels},le="60"}} 1\n' in text
+    assert f'{name}_bucket{{{labels},le="1200"}} 2\n' in text
+    assert f'{name}_bucket{{{labels},le="+Inf"}} 2\n' in text
+    assert f"{name}_sum{{{labels}}} 930\n" in text
+    assert f"{name}_count{{{labels}}} 2\n" in text
+    assert "# TYPE koji_image_builder_build_duration_seconds histogram\n" in text
+
+    # nothing is left behind besides the textfile, its state, and the lock
+    assert sorted(p.basename for p in tmpdir.join("metrics").listdir()) == [
+        "koji_image_builder.prom",
+        "koji_image_builder.prom.json",
+        "koji_image_builder.prom.lock",
+    ]
+
+
+def test_build_arch_task_metrics(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    config = configparser.ConfigParser()
+    config["metrics"] = {"path": str(tmpdir / "metrics" / "koji.prom")}
+    config["store_cache"] = {"path": str(tmpdir / "store")}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    def mock(self, args):
+        return 1
+
+    koji_mock_kojid.patch.object(koji_mock_kojid.buildroot, "mock", mock)
+
+    t = builder.ImageBuilderBuildArchTask()
+
+    t.id = None
+    t.session = None
+    t.options = MockOptions(topurl="/")
+    t.workdir = None
+
+    with pytest.raises(koji.GenericError):
+        t.handler(
+            "Fedora-Minimal",
+            "42",
+            "1",
+            "x86_64",
+            ["minimal-raw"],
+            {"build_tag": "f42-build", "build_tag_name": "f42-build"},
+            {"extra": {"mock.new_chroot": 0}},
+            {"id": 1},
+            {},
+        )
+
+    text = tmpdir.join("metrics", "koji.prom").read()
+
+    assert 'koji_image_builder_tasks_total{arch="x86_64",result="failure"} 1\n' in text
+    assert 'koji_image_builder_failures_total{arch="x86_64",phase="build"} 1\n' in text
+    assert (
+        'koji_image_builder_cache_requests_total{cache="store_cache",result="miss"} 1\n'
+        in text
+    )
+
+
+AUTO_WEIGHT = {"image_builder.task_weight": "auto"}
+
+
+@pytest.mark.parametrize(
+    "types,extra,opts,expected",
+    [
+        (["minimal-installer"], {}, {}, 0.2),
+        (["minimal-raw"], AUTO_WEIGHT, {}, 1.0),
+        (["minimal-raw", "minimal-installer"], AUTO_WEIGHT, {}, 2.0),
+        (
+            ["minimal-raw", "minimal-installer"],
+            {**AUTO_WEIGHT, "image_builder.max_concurrent_types": 2},
+            {},
+            3.0,
+        ),
+        (["bootc-installer"], AUTO_WEIGHT, {"bootc": {"ref": "a"}}, 2.5),
+        (["minimal-raw"], AUTO_WEIGHT, {"manifest_only": True}, 0.2),
+        (["minimal-installer"], {"image_builder.task_weight": "0.5"}, {}, 0.5),
+        (["minimal-installer"], {"image_builder.task_weight": "heavy"}, {}, 0.2),
+        (
+            ["minimal-raw"],
+            {**AUTO_WEIGHT, "image_builder.max_concurrent_types": "many"},
+            {},
+            0.2,
+        ),
+    ],
+)
+def test_build_arch_task_weight(koji_mock_kojid, types, extra, opts, expected):
+    import plugin.builder.image_builder as builder
+
+    koji_mock_kojid.patch.object(
+        builder, "read_config", return_value=configparser.ConfigParser()
+    )
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.params = [
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        types,
+        {},
+        {"extra": extra},
+        {"id": 1},
+        opts,
+    ]
+
+    assert t.weight() == expected
+
+
+def test_build_arch_task_weight_history(koji_mock_kojid, tmpdir):
+    import plugin.builder.image_builder as builder
+
+    path = str(tmpdir.join("koji.prom"))
+
+    config = configparser.ConfigParser()
+    config["metrics"] = {"path": path}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    metrics = builder.Metrics(path)
+
+    for duration in (3600, 5400):
+        metrics.observe(
+            "koji_image_builder_build_duration_seconds",
+            {"arch": "x86_64", "type": "minimal-raw"},
+            duration,
+        )
+
+    metrics.write()
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.params = [
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {},
+        {"extra": AUTO_WEIGHT},
+        {"id": 1},
+        {},
+    ]
+
+    # the type took 75 minutes on average
+    assert t.weight() == 1.0 + 1.25
+
+
+@pytest.mark.parametrize(
+    "state",
+    ["", "[]", "{}", '{"histograms": {}}'],
+)
+def test_build_arch_task_weight_broken_history(koji_mock_kojid, tmpdir, state):
+    import plugin.builder.image_builder as builder
+
+    path = str(tmpdir.join("koji.prom"))
+    tmpdir.join("koji.prom.json").write(state)
+
+    config = configparser.ConfigParser()
+    config["metrics"] = {"path": path}
+
+    koji_mock_kojid.patch.object(builder, "read_config", return_value=config)
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.params = [
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {},
+        {"extra": AUTO_WEIGHT},
+        {"id": 1},
+        {},
+    ]
+
+    assert t.weight() == 1.0
+
+
+def test_build_arch_task_weight_broken_config(koji_mock_kojid):
+    import plugin.builder.image_builder as builder
+
+    koji_mock_kojid.patch.object(
+        builder, "read_config", side_effect=configparser.Error("broken")
+    )
+
+    t = builder.ImageBuilderBuildArchTask()
+    t.params = [
+        "Fedora-Minimal",
+        "42",
+        "1",
+        "x86_64",
+        ["minimal-raw"],
+        {},
+        {"extra": AUTO_WEIGHT},
+        {"id": 1},
+        {},
+    ]
+
+    assert t.weight() == 0.2
@@ -0,0 +1,345 @@
+import json
+
+import koji
+import pytest
+
+
+def test_read_builds(tmpdir):
+    import plugin.cli.image_builder as cli
+
+    tmpdir.join("minimal.json").write(json.dumps({"name": "minimal"}))
+    tmpdir.join("builds.yaml").write(
+        """
+- target: f42
+  name: Fedora-Minimal
+  version: "42"
+  types: [minimal-raw]
+  arches: [x86_64]
+  blueprint: minimal.json
+- target: f42
+  name: Fedora-Container
+  version: "42"
+  types: [container]
+  scratch: false
+  compress: xz
+"""
+    )
+
+    builds = cli.read_builds(str(tmpdir.join("builds.yaml")), {"scratch": True, "compress": "zstd"})
+
+    assert builds == [
+        {
+            "target": "f42",
+            "arches": ["x86_64"],
+            "types": ["minimal-raw"],
+            "name": "Fedora-Minimal",
+            "version": "42",
+            "opts": {"scratch": True, "compress": "zstd", "blueprint": {"name": "minimal"}},
+        },
+        {
+            "target": "f42",
+            "arches": [],
+            "types": ["container"],
+            "name": "Fedora-Container",
+            "version": "42",
+            "opts": {"scratch": False, "compress": "xz"},
+        },
+    ]
+
+
+def test_read_builds_json(tmpdir):
+    import plugin.cli.image_builder as cli
+
+    spec = {"target": "f42", "name": "Fedora-Minimal", "version": "42", "types": ["minimal-raw"]}
+    tmpdir.join("builds.json").write(json.dumps([spec]))
+
+    builds = cli.read_builds(str(tmpdir.join("builds.json")), {})
+
+    assert builds[0]["opts"] == {}
+
+
+@pytest.mark.parametrize("version", ["42", "42.10"])
+def test_read_builds_version_not_a_string(tmpdir, version):
+    import plugin.cli.image_builder as cli
+
+    tmpdir.join("builds.yaml").write(
+        f"""
+- target: f42
+  name: Fedora-Minimal
+  version: {version}
+  types: [minimal-raw]
+"""
+    )
+
+    with pytest.raises(koji.GenericError, match="version that is not a string"):
+        cli.read_builds(str(tmpdir.join("builds.yaml")), {})
+
+
+def test_submit_builds(mocker, tmpdir, capsys):
+    import plugin.cli.image_builder as cli
+
+    tmpdir.join("builds.yaml").write(
+        """
+- target: f42
+  name: Fedora-Minimal
+  version: "42"
+  types: [minimal-raw]
+- target: f42
+  name: Fedora-Server
+  version: "42"
+  types: [server-qcow2]
+  arches: [aarch64]
+- target: f42
+  name: Fedora-Broken
+  version: "42"
+  types: []
+"""
+    )
+
+    class Session:
+        def hasPerm(self, perm):
+            return perm == "image"
+
+        def imageBuilderBuildBatch(self, builds):
+            self.builds = builds
+            return [1, 2, {"faultCode": 1000, "faultString": "[] should be non-empty"}]
+
+    session = Session()
+
+    mocker.patch.object(cli.kl, "activate_session")
+    watch = mocker.patch.object(cli, "watch_builds", return_value=0)
+
+    gopts = mocker.Mock(quiet=False, poll_interval=5)
+
+    rv = cli.handle_image_builder_build(
+        gopts,
+        session,
+        ["--arch", "x86_64", "--scratch", "--from-file", str(tmpdir.join("builds.yaml"))],
+    )
+
+    # the options on the command line apply to builds that don't set them
+    assert [(b["name"], b["arches"], b["opts"]) for b in session.builds] == [
+        ("Fedora-Minimal", ["x86_64"], {"scratch": True}),
+        ("Fedora-Server", ["aarch64"], {"scratch": True}),
+        ("Fedora-Broken", ["x86_64"], {"scratch": True}),
+    ]
+
+    # the builds that were created are watched, the invalid one fails the
+    # command
+    watch.assert_called_once_with(session, [1, 2], quiet=False, poll_interval=5)
+    assert rv == 1
+
+    captured = capsys.readouterr()
+
+    assert "Fedora-Minimal-42 (f42): task 1" in captured.out
+    assert "Fedora-Broken-42 (f42): [] should be non-empty" in captured.err
+
+
+def test_submit_builds_with_arguments(mocker, tmpdir, capsys):
+    import plugin.cli.image_builder as cli
+
+    mocker.patch.object(cli.kl, "activate_session")
+
+    with pytest.raises(SystemExit):
+        cli.handle_image_builder_build(
+            mocker.Mock(), mocker.Mock(), ["--from-file", str(tmpdir.join("builds.yaml")), "f42"]
+        )
+
+    assert "no arguments are accepted with --from-file" in capsys.readouterr().err
+
+
+def test_build_watches_task(mocker, capsys):
+    import plugin.cli.image_builder as cli
+
+    class Session:
+        def hasPerm(self, perm):
+            return perm == "image"
+
+        def imageBuilderBuild(self, *args, opts=None):
+            return 1
+
+        def getTaskInfo(self, task_id, request=False):
+            return {
+                "id": task_id,
+                "method": "imageBuilderBuild",
+                "arch": "noarch",
+                "state": koji.TASK_STATES["CLOSED"],
+                "host_id": None,
+                "request": [],
+            }
+
+        def getTaskChildren(self, task_id):
+            return []
+
+    mocker.patch.object(cli.kl, "activate_session")
+    watch = mocker.spy(cli.kl, "watch_tasks")
+
+    gopts = mocker.Mock(quiet=False, poll_interval=0, topurl="https://koji")
+
+    rv = cli.handle_image_builder_build(
+        gopts, Session(), ["f42", "Fedora-Minimal", "42", "minimal-raw"]
+    )
+
+    assert rv == 0
+    assert watch.call_args.kwargs["topurl"] == "https://koji"
+
+    # the result of the task is printed when it's done
+    assert "1 imageBuilderBuild (noarch) completed successfully" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "content,message",
+    [
+        ('{"target": "f42"}', "does not contain a list of builds"),
+        ('["f42"]', "build 0 in"),
+        ('[{"target": "f42", "name": "Fedora-Minimal"}]', "is missing: version, types"),
+    ],
+)
+def test_read_builds_invalid(tmpdir, content, message):
+    import plugin.cli.image_builder as cli
+
+    tmpdir.join("builds.json").write(content)
+
+    with pytest.raises(koji.GenericError, match=message):
+        cli.read_builds(str(tmpdir.join("builds.json")), {})
+
+
+class MockCall:
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.error = None
+        self.value = None
+
+    @property
+    def result(self):
+        if self.error:
+            raise self.error
+
+        return self.value
+
+
+class MockMultiCall:
+    """A stand-in for a koji multicall, calls are done when it exits."""
+
+    def __init__(self, session, batch):
+        self.session = session
+        self.batch = batch
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.session.multicalls.append((self.batch, len(self.calls)))
+
+        for call in self.calls:
+            try:
+                call.value = getattr(self.session, call.method)(*call.args, **call.kwargs)
+            except koji.GenericError as e:
+                call.error = e
+
+        return False
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            call = MockCall(name, args, kwargs)
+            self.calls.append(call)
+            return call
+
+        return method
+
+
+class MockWatchSession:
+    """Returns task states from a script, one entry per poll. Each entry maps
+    task ids to the state of the task and the states of its arch tasks."""
+
+    def __init__(self, script):
+        self.script = script
+        self.tick = -1
+        self.multicalls = []
+
+    def multicall(self, strict=False, batch=None):
+        if strict:
+            self.tick = min(self.tick + 1, len(self.script) - 1)
+
+        return MockMultiCall(self, batch)
+
+    def getTaskInfo(self, task_id, request=False):
+        info = {
+            "id": task_id,
+            "method": "imageBuilderBuild",
+            "state": koji.TASK_STATES[self.script[self.tick][task_id][0]],
+        }
+
+        if request:
+            info["request"] = ["f42", [], ["minimal-raw"], "Fedora-Minimal", "42", {}]
+
+        return info
+
+    def getTaskChildren(self, task_id):
+        arches = self.script[self.tick][task_id][1]
+
+        return [
+            {"id": task_id * 10 + i, "label": arch, "state": koji.TASK_STATES[state]}
+            for i, (arch, state) in enumerate(sorted(arches.items()))
+        ]
+
+    def getTaskResult(self, task_id):
+        raise koji.GenericError(f"task {task_id} failed")
+
+
+def test_watch_builds(mocker, capsys):
+    import plugin.cli.image_builder as cli
+
+    sleep = mocker.patch("time.sleep")
+
+    running = ("OPEN", {"x86_64": "OPEN", "aarch64": "OPEN"})
+    session = MockWatchSession(
+        [
+            {1: running, 2: running},
+            {1: running, 2: running},
+            {1: running, 2: running},
+            {1: ("CLOSED", {"x86_64": "CLOSED", "aarch64": "CLOSED"}), 2: running},
+            {2: ("FAILED", {"x86_64": "CLOSED", "aarch64": "FAILED"})},
+        ]
+    )
+
+    assert cli.watch_builds(session, [1, 2], poll_interval=5) == 1
+
+    # intervals double while nothing changes and reset when something does
+    assert [c.args[0] for c in sleep.call_args_list] == [5, 10, 20, 5]
+
+    # finished builds are no longer polled, the last multicall fetches the
+    # errors of the failed tasks
+    assert [n for _, n in session.multicalls] == [4, 4, 4, 4, 2, 2]
+
+    out = capsys.readouterr().out
+
+    assert "TASK  BUILD              STATE   aarch64  x86_64" in out
+    assert "1     Fedora-Minimal-42  closed  closed   closed" in out
+    assert "2 Fedora-Minimal-42: GenericError: task 2 failed" in out
+    assert "20 Fedora-Minimal-42 aarch64: GenericError: task 20 failed" in out
+
+
+def test_watch_builds_many(mocker):
+    import plugin.cli.image_builder as cli
+
+    mocker.patch("time.sleep")
+
+    task_ids = list(range(1, 501))
+    session = MockWatchSession(
+        [
+            {t: ("OPEN", {"x86_64": "OPEN"}) for t in task_ids},
+            {t: ("CLOSED", {"x86_64": "CLOSED"}) for t in task_ids},
+        ]
+    )
+
+    assert cli.watch_builds(session, task_ids, quiet=True) == 0
+
+    # one multicall per poll, split in batches by the session
+    assert session.multicalls == [
+        (cli.WATCH_BATCH, 1000),
+        (cli.WATCH_BATCH, 1000),
+    ]
@@ -0,0 +1,274 @@
+import os
+import time
+import hashlib
+
+import koji
+import pytest
+
+
+def striped(data, blocksize, parts):
+    """Split data in blocks that are distributed round robin over parts, the
+    way the builder plugin uploads large files."""
+
+    blocks = [data[i:i + blocksize] for i in range(0, len(data), blocksize)]
+
+    return [b"".join(blocks[i::parts]) for i in range(parts)]
+
+
+@pytest.mark.parametrize("size", [1, 4095, 4096, 4097, 10 * 4096 + 17])
+def test_assemble_upload(koji_mock_kojihub, tmpdir, size):
+    import plugin.hub.image_builder as hub
+
+    data = bytes(i % 251 for i in range(size))
+    sources = []
+
+    for i, part in enumerate(striped(data, 4096, 3)):
+        tmpdir.join(f"part{i}").write_binary(part)
+        sources.append(str(tmpdir.join(f"part{i}")))
+
+    dest = tmpdir.join("dest")
+
+    checksum = hub.assemble_upload(sources, str(dest), 4096, size)
+
+    assert dest.read_binary() == data
+    assert checksum == hashlib.sha256(data).hexdigest()
+
+
+def test_assemble_upload_incomplete(koji_mock_kojihub, tmpdir):
+    import plugin.hub.image_builder as hub
+
+    tmpdir.join("part0").write_binary(b"a" * 10)
+
+    with pytest.raises(koji.GenericError, match="incomplete"):
+        hub.assemble_upload([str(tmpdir.join("part0"))], str(tmpdir.join("dest")), 4, 11)
+
+    with pytest.raises(koji.GenericError, match="trailing"):
+        hub.assemble_upload([str(tmpdir.join("part0"))], str(tmpdir.join("dest")), 4, 9)
+
+
+def test_assemble_upload_sparse(koji_mock_kojihub, tmpdir):
+    import plugin.hub.image_builder as hub
+
+    size = 64 * 4096
+    extents = [(4096, 5000), (32 * 4096, 4096), (60 * 4096, 100)]
+
+    data = bytearray(size)
+
+    for offset, length in extents:
+        data[offset:offset + length] = os.urandom(length)
+
+    uploaded = b"".join(data[o:o + n] for o, n in extents)
+    sources = []
+
+    for i, part in enumerate(striped(uploaded, 4096, 2)):
+        tmpdir.join(f"part{i}").write_binary(part)
+        sources.append(str(tmpdir.join(f"part{i}")))
+
+    dest = tmpdir.join("dest")
+
+    checksum = hub.assemble_upload(sources, str(dest), 4096, size, extents)
+
+    assert dest.read_binary() == data
+    assert checksum == hashlib.sha256(uploaded).hexdigest()
+
+    # the holes aren't written
+    assert os.stat(str(dest)).st_blocks * 512 < size
+
+
+def test_assemble_upload_invalid_extents(koji_mock_kojihub, tmpdir):
+    import plugin.hub.image_builder as hub
+
+    tmpdir.join("part0").write_binary(b"a" * 8)
+
+    with pytest.raises(koji.GenericError, match="invalid extents"):
+        hub.assemble_upload(
+            [str(tmpdir.join("part0"))], str(tmpdir.join("dest")), 4, 16, [(8, 4), (0, 4)]
+        )
+
+
+class MockSession:
+    def __init__(self, perms=("image",)):
+        self.perms = perms
+
+    def assertPerm(self, perm):
+        if perm not in self.perms:
+            raise koji.ActionNotAllowed(f"{perm} permission required")
+
+    def hasPerm(self, perm):
+        return perm in self.perms
+
+
+@pytest.fixture
+def hub(koji_mock_kojihub, mocker):
+    import plugin.hub.image_builder as hub
+
+    mocker.patch.object(hub, "context", mocker.Mock(session=MockSession()))
+
+    tasks = []
+
+    def make_task(method, args, **opts):
+        tasks.append((method, args, opts))
+        return len(tasks)
+
+    koji_mock_kojihub.make_task = make_task
+    hub.tasks = tasks
+
+    return hub
+
+
+def test_image_builder_build(hub):
+    task_id = hub.imageBuilderBuild(
+        "f42", [], ["minimal-raw"], "Fedora-Minimal", "42", {"seed": 1}
+    )
+
+    assert task_id == 1
+    assert hub.tasks == [
+        (
+            "imageBuilderBuild",
+            ["f42", [], ["minimal-raw"], "Fedora-Minimal", "42", {"seed": 1}],
+            {"channel": "image"},
+        )
+    ]
+
+
+@pytest.mark.parametrize(
+    "args,message",
+    [
+        (["f42", [], [], "Fedora-Minimal", "42"], r"\[\] should be non-empty"),
+        (
+            ["f42", [], ["minimal-raw"], "Fedora-Minimal", "42", {"seed": "1"}],
+            "'1' is not of type 'integer'",
+        ),
+        (
+            ["f42", [], ["minimal-raw"], "Fedora-Minimal", "42", {"bogus": True}],
+            "Additional properties are not allowed",
+        ),
+    ],
+)
+def test_image_builder_build_invalid(hub, args, message):
+    with pytest.raises(koji.ParameterError, match=message):
+        hub.imageBuilderBuild(*args)
+
+    assert hub.tasks == []
+
+
+@pytest.mark.skipif(
+    not os.environ.get("KOJI_IMAGE_BUILDER_BENCHMARK"),
+    reason="benchmarks only run with KOJI_IMAGE_BUILDER_BENCHMARK set",
+)
+def test_validate_build_args_benchmark(hub):
+    """Validating with the precompiled validator is cheaper than validating
+    with `jsonschema.validate`, which checks the schema and creates a new
+    validator on every call. Run with `-s` to see the numbers."""
+
+    import jsonschema
+
+    # a large blueprint, such as one with a lot of packages and files
+    blueprint = {
+        "packages": [{"name": f"package-{i}", "version": "*"} for i in range(5000)],
+        "customizations": {
+            "files": [{"path": f"/etc/{i}", "data": "x" * 100} for i in range(1000)],
+        },
+    }
+
+    args = ["f42", [], ["minimal-raw"], "Fedora-Minimal", "42"]
+    args.append({"blueprint": blueprint})
+
+    calls = 200
+
+    start = time.perf_counter()
+
+    for _ in range(calls):
+        jsonschema.validate(args, hub.IMAGE_BUILDER_BUILD_SCHEMA)
+
+    uncached = (time.perf_counter() - start) / calls
+
+    start = time.perf_counter()
+
+    for _ in range(calls):
+        hub.validate_build_args(args)
+
+    cached = (time.perf_counter() - start) / calls
+
+    print(f"validation per call: {uncached * 1e6:.0f}us -> {cached * 1e6:.0f}us")
+
+    assert cached < uncached
+
+
+def test_image_builder_build_batch(hub):
+    results = hub.imageBuilderBuildBatch(
+        [
+            {
+                "target": "f42",
+                "arches": ["x86_64"],
+                "types": ["minimal-raw"],
+                "name": "Fedora-Minimal",
+                "version": "42",
+            },
+            {
+                "target": "f42",
+                "arches": [],
+                "types": [],
+                "name": "Fedora-Minimal",
+                "version": "42",
+            },
+            {"target": "f42", "bogus": True},
+            "f42",
+            {
+                "target": "f42",
+                "arches": [],
+                "types": ["server-qcow2"],
+                "name": "Fedora-Server",
+                "version": "42",
+                "opts": {"scratch": True},
+            },
+        ]
+    )
+
+    fault = koji.ParameterError.faultCode
+
+    assert results[1]["faultString"].startswith("[] should be non-empty")
+    results[1]["faultString"] = "[] should be non-empty"
+
+    assert results == [
+        1,
+        {"faultCode": fault, "faultString": "[] should be non-empty"},
+        {"faultCode": fault, "faultString": "build 2 has unknown keys: bogus"},
+        {"faultCode": fault, "faultString": "build 3 is not a mapping"},
+        2,
+    ]
+
+    assert [args for (_, args, _) in hub.tasks] == [
+        ["f42", ["x86_64"], ["minimal-raw"], "Fedora-Minimal", "42", {}],
+        ["f42", [], ["server-qcow2"], "Fedora-Server", "42", {"scratch": True}],
+    ]
+
+
+def test_image_builder_build_batch_permissions(hub):
+    hub.context.session = MockSession(perms=())
+
+    with pytest.raises(koji.ActionNotAllowed):
+        hub.imageBuilderBuildBatch([])
+
+    hub.context.session = MockSession()
+
+    with pytest.raises(koji.ActionNotAllowed, match="high-priority"):
+        hub.imageBuilderBuildBatch([], priority=-1)
+
+
+def test_image_builder_build_batch_priority(hub):
+    build = {
+        "target": "f42",
+        "arches": [],
+        "types": ["minimal-raw"],
+        "name": "Fedora-Minimal",
+        "version": "42",
+    }
+
+    hub.imageBuilderBuildBatch([build])
+    hub.imageBuilderBuildBatch([build], priority=30)
+
+    assert [opts for (_, _, opts) in hub.tasks] == [
+        {"channel": "image"},
+        {"channel": "image", "priority": 30},
+    ]